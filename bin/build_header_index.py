@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""Save header values of FITS files in a directory to a $HEAD{} index.
+"""
+
+import os
+import sys
+import fnmatch
+import argparse
+
+import despymisc.miscutils as miscutils
+import intgutils.intgdefs as intgdefs
+import intgutils.headerindex as headerindex
+
+
+def find_files(topdir, pattern, recursive):
+    """Yield paths of files in topdir whose names match pattern.
+    """
+    for (dirpath, dirnames, filenames) in os.walk(topdir):
+        for fname in sorted(filenames):
+            if fnmatch.fnmatch(fname, pattern):
+                yield os.path.join(dirpath, fname)
+        if not recursive:
+            del dirnames[:]
+
+
+def main():
+    """Entry point.
+    """
+    parser = argparse.ArgumentParser(description='Save FITS header values used by $HEAD{} variables')
+    parser.add_argument('topdir', nargs='+', action='store')
+    parser.add_argument('--index', action='store', default=os.environ.get(intgdefs.HEAD_INDEX_ENV),
+                        help='sqlite file (default $%s)' % intgdefs.HEAD_INDEX_ENV)
+    parser.add_argument('--keys', action='store', default=None,
+                        help='comma separated header keywords (default all)')
+    parser.add_argument('--pattern', action='store', default='*.fits*')
+    parser.add_argument('--recursive', action='store_true', default=False)
+    args = parser.parse_args(sys.argv[1:])
+
+    if not args.index:
+        parser.error('Must give --index or set %s' % intgdefs.HEAD_INDEX_ENV)
+
+    keys = None
+    if args.keys:
+        keys = miscutils.fwsplit(args.keys, ',')
+
+    index = headerindex.HeaderIndex(args.index)
+    nfiles = 0
+    nerrors = 0
+    for topdir in args.topdir:
+        for path in find_files(topdir, args.pattern, args.recursive):
+            try:
+                index.add_file(path, keys)
+                nfiles += 1
+            except Exception as err:
+                print("Skipping %s: %s" % (path, err))
+                nerrors += 1
+    index.close()
+
+    print("Saved headers for %s files to %s (%s skipped)" % (nfiles, args.index, nerrors))
+    sys.exit(1 if nerrors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -38,6 +38,16 @@ class BasicWrapper(object):
             self.inputwcl.read(infh)
         self.debug = debug
 
+        wrapsect = self.inputwcl.get(intgdefs.IW_WRAP_SECT)
+
+        # threads reading headers for $HEAD{} (None uses replfuncs.head_cache's)
+        self.head_prefetch_workers = None
+        if wrapsect and intgdefs.IW_HEAD_PREFETCH_WORKERS in wrapsect:
+            self.head_prefetch_workers = int(wrapsect[intgdefs.IW_HEAD_PREFETCH_WORKERS])
+
+        # answers whether input and output files exist
+        self.file_backend = intgmisc.get_file_backend(wrapsect)
+
         # note: WGB handled by file registration using OW_OUTPUTS_BY_SECT
         provdict = OrderedDict({provdefs.PROV_USED: OrderedDict(),
                                 provdefs.PROV_WDF: OrderedDict()})
@@ -131,6 +141,14 @@ class BasicWrapper(object):
                 if 'cmd_hyphen' in exwcl:
                     hyphen_type = exwcl['cmd_hyphen']
 
+                # variables shared between args are only resolved once per command line
+                expansion = self.inputwcl.expand_all()
+
+                # read header values for all $HEAD{} args with one open per file
+                replfuncs.prefetch_head_values(exwcl['cmdline'].values(),
+                                               self.inputwcl.scope(None),
+                                               self.head_prefetch_workers)
+
                 # loop through command line args
                 for key, val in list(exwcl['cmdline'].items()):
                     if miscutils.fwdebug_check(3, 'BASICWRAP_DEBUG'):
@@ -138,7 +156,7 @@ class BasicWrapper(object):
                                                 WRAPPER_OUTPUT_PREFIX)
 
                     # replace any variables
-                    expandval = replfuncs.replace_vars(val, self.inputwcl)[0]
+                    expandval = expansion.expand(val)
                     if miscutils.fwdebug_check(3, 'BASICWRAP_DEBUG'):
                         miscutils.fwdebug_print("expandval = '%s'" % (expandval),
                                                 WRAPPER_OUTPUT_PREFIX)
@@ -356,8 +374,9 @@ class BasicWrapper(object):
         missingfiles = []
 
         ins, _ = intgmisc.get_fullnames(self.inputwcl, self.inputwcl, ekey)
+        checked = intgmisc.check_files_by_sect(ins, backend=self.file_backend)
         for sect in ins:
-            exists, missing = intgmisc.check_files(ins[sect])
+            exists, missing = checked[sect]
             existfiles[sect] = exists
 
             if len(missing) != 0:
@@ -455,11 +474,12 @@ class BasicWrapper(object):
         missingfiles = {}
 
         _, outs = intgmisc.get_fullnames(self.inputwcl, self.inputwcl, ekey)
+        checked = intgmisc.check_files_by_sect(outs, backend=self.file_backend)
         for sect in outs:
             if miscutils.fwdebug_check(3, 'BASICWRAP_DEBUG'):
                 miscutils.fwdebug_print("INFO: sect=%s" % sect, WRAPPER_OUTPUT_PREFIX)
 
-            exists, missing = intgmisc.check_files(outs[sect])
+            exists, missing = checked[sect]
             existfiles.update({sect: exists})
             if len(missing) > 0:
                 optout = self.get_optout(sect)
@@ -636,11 +656,13 @@ class BasicWrapper(object):
         self.end_exec_task(num_errs)
         return prov
 
-    def write_outputwcl(self, outfilename=None):
+    def write_outputwcl(self, outfilename=None, outtype=None):
         """Write output wcl to file.
         """
         if outfilename is None:
             outfilename = self.inputwcl['wrapper']['outputwcl']
+        if outtype is None:
+            outtype = self.inputwcl['wrapper'].get(intgdefs.IW_OUTPUTWCL_FORMAT)
 
         if miscutils.fwdebug_check(3, 'BASICWRAP_DEBUG'):
             miscutils.fwdebug_print("outfilename = %s" % outfilename, WRAPPER_OUTPUT_PREFIX)
@@ -654,6 +676,9 @@ class BasicWrapper(object):
         with open(outfilename, 'w') as wclfh:
             self.outputwcl.write(wclfh, True)
 
+        if outtype is not None and outtype != intgdefs.WCL_FORMAT_WCL:
+            self.outputwcl.write_file('%s.%s' % (outfilename, outtype), True, outtype=outtype)
+
     def start_exec_task(self, name):
         """Save start execution info.
         """
@@ -730,6 +755,12 @@ class BasicWrapper(object):
             if miscutils.fwdebug_check(6, 'BASICWRAP_DEBUG'):
                 miscutils.fwdebug_print("INFO:  exec sections = %s" % execs, WRAPPER_OUTPUT_PREFIX)
 
+            # read headers for $HEAD{} in filespecs concurrently up front
+            if intgdefs.IW_FILE_SECT in self.inputwcl:
+                replfuncs.prefetch_wcl_head_values(self.inputwcl[intgdefs.IW_FILE_SECT],
+                                                   self.inputwcl.scope(None),
+                                                   self.head_prefetch_workers)
+
             for ekey, iw_exec in sorted(execs.items()):
                 ow_exec = {'task_info': {}}
                 self.outputwcl[ekey] = ow_exec
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""Persistent index of FITS header values used by $HEAD{} variables.
+"""
+
+import os
+import sqlite3
+
+from astropy.io import fits
+import despymisc.miscutils as miscutils
+from despyfitsutils import fitsutils
+import intgutils.intgdefs as intgdefs
+
+# header cards that are not single valued keywords
+_SKIP_KEYS = set(['', 'COMMENT', 'HISTORY'])
+
+
+def file_signature(path):
+    """Return (size, mtime) used to validate index entries for given file.
+    """
+    fstat = os.stat(path)
+    return (fstat.st_size, fstat.st_mtime_ns)
+
+
+class HeaderIndex(object):
+    """Header values stored in a local sqlite file.
+    """
+
+    VERSION = 1
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+
+    def _connect(self):
+        """Return connection to index creating tables if needed.
+        """
+        if self._conn is None:
+            dbdir = os.path.dirname(os.path.abspath(self.dbfile))
+            miscutils.coremakedirs(dbdir)
+            conn = sqlite3.connect(self.dbfile, timeout=intgdefs.HEAD_INDEX_TIMEOUT)
+            with conn:
+                conn.execute("create table if not exists head_files "
+                             "(path text primary key, size integer, mtime integer, "
+                             "version integer)")
+                conn.execute("create table if not exists head_values "
+                             "(path text, key text, value text, primary key (path, key))")
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        """Close connection to index.
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get(self, path, sig, keys):
+        """Return dict of stored values for keys in file with given signature.
+        """
+        path = os.path.abspath(path)
+        values = {}
+        try:
+            conn = self._connect()
+            row = conn.execute("select size, mtime, version from head_files where path=?",
+                               (path,)).fetchone()
+            if row is not None and tuple(row[:2]) == tuple(sig) and row[2] == self.VERSION:
+                ukeys = dict((key.upper(), key) for key in keys)
+                for (ukey, value) in conn.execute("select key, value from head_values "
+                                                  "where path=?", (path,)):
+                    if ukey in ukeys:
+                        values[ukeys[ukey]] = value
+        except sqlite3.Error as err:
+            if miscutils.fwdebug_check(1, 'REPL_DEBUG'):
+                miscutils.fwdebug_print("Could not read header index %s: %s" %
+                                        (self.dbfile, err))
+
+        if len(values) == len(keys):
+            self.hits += 1
+        else:
+            self.misses += 1
+        return values
+
+    def put(self, path, sig, values):
+        """Save header values for file with given signature.
+        """
+        path = os.path.abspath(path)
+        try:
+            conn = self._connect()
+            with conn:
+                row = conn.execute("select size, mtime, version from head_files where path=?",
+                                   (path,)).fetchone()
+                if row is None or tuple(row[:2]) != tuple(sig) or row[2] != self.VERSION:
+                    conn.execute("delete from head_values where path=?", (path,))
+                    conn.execute("insert or replace into head_files values (?, ?, ?, ?)",
+                                 (path, sig[0], sig[1], self.VERSION))
+                conn.executemany("insert or replace into head_values values (?, ?, ?)",
+                                 [(path, key.upper(), value) for (key, value) in values.items()])
+        except sqlite3.Error as err:
+            if miscutils.fwdebug_check(1, 'REPL_DEBUG'):
+                miscutils.fwdebug_print("Could not save to header index %s: %s" %
+                                        (self.dbfile, err))
+
+    def add_file(self, path, keys=None):
+        """Read and save header values of keys (all keywords if None) in file.
+        """
+        sig = file_signature(path)
+        hdulist = fits.open(path, 'readonly')
+        try:
+            if keys is None:
+                keys = []
+                for hdu in hdulist:
+                    for key in hdu.header.keys():
+                        if key not in _SKIP_KEYS and key not in keys:
+                            keys.append(key)
+            values = {}
+            for key in keys:
+                values[key] = str(fitsutils.get_hdr_value(hdulist, key))
+        finally:
+            hdulist.close()
+        self.put(path, sig, values)
+        return len(values)
+
+
+def header_index_from_env():
+    """Return HeaderIndex using file from environment or None if not set.
+    """
+    dbfile = os.environ.get(intgdefs.HEAD_INDEX_ENV)
+    if dbfile:
+        return HeaderIndex(dbfile)
+    return None
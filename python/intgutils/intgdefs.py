@@ -3,6 +3,66 @@
 
 REPLACE_VARS = 'replace_vars'
 
+# number of compiled replace_vars templates kept
+REPLACE_VARS_TEMPLATE_CACHE_SIZE = 4096
+
+# number of FITS files whose $HEAD{} values are kept
+HEAD_CACHE_SIZE = 256
+
+# threads reading FITS headers when prefetching $HEAD{} values
+HEAD_PREFETCH_WORKERS = 8
+
+# threads checking that files exist, files in one directory at which it is
+# listed instead (0 never) and max directory entries read per file checked
+CHECK_FILES_WORKERS = 8
+CHECK_FILES_SCANDIR_MIN = 16
+CHECK_FILES_SCANDIR_RATIO = 64
+
+# backends answering whether files exist (intgmisc.get_file_backend)
+FILE_BACKEND_FILESYSTEM = 'filesystem'
+FILE_BACKEND_CATALOG = 'catalog'
+
+# environment variable naming sqlite file of persistent $HEAD{} values and
+# seconds to wait for it when locked by another process
+HEAD_INDEX_ENV = 'HEAD_INDEX_FILE'
+HEAD_INDEX_TIMEOUT = 30
+
+# number of $FUNC{} results kept for functions declared pure
+FUNC_RESULT_CACHE_SIZE = 4096
+
+# WCL.read parser engines
+WCL_PARSER_LINE = 'line'
+WCL_PARSER_TOKEN = 'token'
+WCL_DEFAULT_PARSER = WCL_PARSER_LINE
+
+# serialization formats for WCL.read/WCL.write
+WCL_FORMAT_WCL = 'wcl'
+WCL_FORMAT_JSON = 'json'
+WCL_FORMAT_MARSHAL = 'marshal'
+WCL_FORMATS = [WCL_FORMAT_WCL, WCL_FORMAT_JSON, WCL_FORMAT_MARSHAL]
+
+# environment variable naming directory for persistent WCL parse cache
+WCL_PARSE_CACHE_ENV = 'WCL_PARSE_CACHE_DIR'
+
+# number of parsed include files kept in memory (off unless set), their
+# sections are shared read-only by the wcls including them
+WCL_INCLUDE_CACHE_ENV = 'WCL_INCLUDE_CACHE_SIZE'
+WCL_INCLUDE_CACHE_SIZE = 64
+
+# number of dotted keys remembered per top-level WCL section (later keys
+# are looked up without being remembered)
+WCL_PATH_INDEX_SIZE = 4096
+
+# number of WCL.getfull results kept per WCL
+WCL_GETFULL_CACHE_SIZE = 1024
+
+# cache of <<inclfunc>> results (off unless one is set): directory shared
+# between processes and seconds results stay valid (in memory only if no
+# directory)
+WCL_INCLFUNC_CACHE_ENV = 'WCL_INCLFUNC_CACHE_DIR'
+WCL_INCLFUNC_CACHE_TTL_ENV = 'WCL_INCLFUNC_CACHE_TTL'
+WCL_INCLFUNC_CACHE_TTL = 3600
+
 
 LISTENTRY = 'line'
 LIST_FORMAT = 'format'
@@ -29,6 +89,17 @@ IW_WRAP_SECT = 'wrapper'
 IW_OUTPUT_OPTIONAL = 'optional'
 IW_FILE_SECT = 'filespecs'
 IW_META_SECT = 'filetype_metadata'
+# also write output wcl in this format (json, marshal) to <outputwcl>.<format>
+IW_OUTPUTWCL_FORMAT = 'outputwcl_format'
+# threads reading FITS headers for $HEAD{} values
+IW_HEAD_PREFETCH_WORKERS = 'head_prefetch_workers'
+# threads and directory listing limits for checking files exist
+IW_CHECK_FILES_WORKERS = 'check_files_workers'
+IW_CHECK_FILES_SCANDIR_MIN = 'check_files_scandir_min'
+IW_CHECK_FILES_SCANDIR_RATIO = 'check_files_scandir_ratio'
+# backend for checking files exist and sqlite file used by catalog backend
+IW_FILE_BACKEND = 'file_backend'
+IW_FILE_CATALOG = 'file_catalog'
 
 #IW_META_HEADERS = 'headers'
 #IW_META_COMPUTE = 'compute'
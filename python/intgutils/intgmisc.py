@@ -3,28 +3,319 @@
 """Contains misc integration utilities.
 """
 
+import abc
 import shlex
 import os
 import re
+import sqlite3
+import urllib.request
+import concurrent.futures
 from despymisc import subprocess4
 from despymisc import miscutils
 from intgutils import intgdefs
 import intgutils.replace_funcs as replfuncs
 
 
-def check_files(fullnames):
+def check_files(fullnames, workers=None, scandir_min=None, backend=None):
     """Check whether given files do exist on disk.
     """
+    fullnames = list(fullnames)
+    if backend is None:
+        backend = FilesystemBackend(workers, scandir_min)
+    found = backend.exists(fullnames)
     exists = []
     missing = []
     for fname in fullnames:
-        if os.path.exists(fname):
+        if found[fname]:
             exists.append(fname)
         else:
             missing.append(fname)
     return (exists, missing)
 
 
+def check_files_by_sect(fullnames, workers=None, scandir_min=None, backend=None):
+    """Return {sect: (exists, missing)} checking files of all sections at once.
+    """
+    if backend is None:
+        backend = FilesystemBackend(workers, scandir_min)
+    found = backend.exists([fname for sect in fullnames for fname in fullnames[sect]])
+    results = {}
+    for sect in fullnames:
+        exists = [fname for fname in fullnames[sect] if found[fname]]
+        missing = [fname for fname in fullnames[sect] if not found[fname]]
+        results[sect] = (exists, missing)
+    return results
+
+
+def files_exist(fullnames, workers=None, scandir_min=None, scandir_ratio=None):
+    """Return {fullname: whether it exists}, listing directories with many files.
+    """
+    if workers is None:
+        workers = intgdefs.CHECK_FILES_WORKERS
+    if scandir_min is None:
+        scandir_min = intgdefs.CHECK_FILES_SCANDIR_MIN
+    if scandir_ratio is None:
+        scandir_ratio = intgdefs.CHECK_FILES_SCANDIR_RATIO
+
+    # group names by directory, names that are not plain files in a
+    # directory (e.g., ending with /) are always checked on their own
+    bydir = {}
+    single = []
+    for fname in set(fullnames):
+        (dirname, basename) = os.path.split(fname)
+        if basename in ('', '.', '..'):
+            single.append(fname)
+        else:
+            bydir.setdefault(dirname, []).append(fname)
+
+    tasks = []
+    for (dirname, fnames) in bydir.items():
+        if 0 < scandir_min <= len(fnames) and scandir_ratio > 0:
+            tasks.append((dirname, fnames, scandir_ratio * len(fnames)))
+        else:
+            single.extend(fnames)
+    # a few chunks per thread keeps the threads busy without a task per file
+    chunksize = max(1, len(single) // (max(workers, 1) * 4))
+    tasks.extend((None, single[i:i + chunksize], 0) for i in range(0, len(single), chunksize))
+
+    found = {}
+    if workers > 1 and len(tasks) > 1:
+        with concurrent.futures.ThreadPoolExecutor(min(workers, len(tasks))) as pool:
+            for result in pool.map(_files_exist_task, tasks):
+                found.update(result)
+    else:
+        for task in tasks:
+            found.update(_files_exist_task(task))
+    return found
+
+
+def _files_exist_task(task):
+    """Return {fullname: whether it exists} for one task of files_exist.
+    """
+    (dirname, fnames, maxentries) = task
+    if dirname is None:
+        return {fname: os.path.exists(fname) for fname in fnames}
+
+    wanted = {os.path.basename(fname): fname for fname in fnames}
+    found = {}
+    complete = True   # whether whole directory was read
+    try:
+        with os.scandir(dirname or '.') as entries:
+            for (cnt, entry) in enumerate(entries):
+                if len(found) == len(wanted):
+                    break
+                if cnt >= maxentries:
+                    complete = False
+                    break
+                fname = wanted.get(entry.name)
+                if fname is not None:
+                    # link may be broken, which os.path.exists reports as missing
+                    found[fname] = not entry.is_symlink() or os.path.exists(fname)
+    except OSError:
+        # e.g., directory not readable, fall back to checking each file
+        return {fname: os.path.exists(fname) for fname in fnames}
+
+    for fname in fnames:
+        if fname not in found:
+            # files not reached in a big directory are checked on their own
+            found[fname] = False if complete else os.path.exists(fname)
+    return found
+
+
+class FileBackend(abc.ABC):
+    """Answers existence and metadata queries for many files per call.
+    """
+
+    def exists(self, fullnames):
+        """Return {fullname: whether file exists}.
+        """
+        return {fname: info is not None for (fname, info) in self.stat(fullnames).items()}
+
+    @abc.abstractmethod
+    def stat(self, fullnames):
+        """Return {fullname: (size, mtime) or None if file does not exist}.
+        """
+
+
+class FilesystemBackend(FileBackend):
+    """Files checked on disk (see files_exist).
+    """
+
+    def __init__(self, workers=None, scandir_min=None, scandir_ratio=None):
+        if workers is None:
+            workers = intgdefs.CHECK_FILES_WORKERS
+        self.workers = workers
+        self.scandir_min = scandir_min
+        self.scandir_ratio = scandir_ratio
+
+    def exists(self, fullnames):
+        """Return {fullname: whether file exists}.
+        """
+        return files_exist(fullnames, self.workers, self.scandir_min, self.scandir_ratio)
+
+    def stat(self, fullnames):
+        """Return {fullname: (size, mtime) or None if file does not exist}.
+        """
+        fnames = list(set(fullnames))
+        chunksize = max(1, len(fnames) // (max(self.workers, 1) * 4))
+        chunks = [fnames[i:i + chunksize] for i in range(0, len(fnames), chunksize)]
+        results = {}
+        if self.workers > 1 and len(chunks) > 1:
+            with concurrent.futures.ThreadPoolExecutor(min(self.workers, len(chunks))) as pool:
+                for result in pool.map(_stat_files, chunks):
+                    results.update(result)
+        else:
+            for chunk in chunks:
+                results.update(_stat_files(chunk))
+        return results
+
+
+def _stat_files(fnames):
+    """Return {fullname: (size, mtime) or None} for given files.
+    """
+    results = {}
+    for fname in fnames:
+        try:
+            fstat = os.stat(fname)
+            results[fname] = (fstat.st_size, fstat.st_mtime)
+        except OSError:
+            results[fname] = None
+    return results
+
+
+class CatalogBackend(FileBackend):
+    """Files looked up in a local sqlite catalog files(path, size, mtime).
+    """
+
+    QUERY_SIZE = 500    # paths per query, below sqlite's variable limit
+
+    def __init__(self, dbfile, fallback=None, verify_missing=True):
+        self.dbfile = dbfile
+        self.fallback = fallback or FilesystemBackend()
+        self.verify_missing = verify_missing
+        self._conn = None
+        self._unreadable = False
+
+    def _connect(self):
+        """Return read-only connection to catalog (never creates it).
+        """
+        if self._conn is None:
+            uri = 'file:%s?mode=ro' % urllib.request.pathname2url(os.path.abspath(self.dbfile))
+            self._conn = sqlite3.connect(uri, uri=True)
+        return self._conn
+
+    def close(self):
+        """Close connection to catalog.
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _lookup(self, fullnames):
+        """Return {fullname: (size, mtime)} of files in catalog (None if unreadable).
+        """
+        if self._unreadable:
+            return None
+
+        bypath = {}
+        for fname in fullnames:
+            bypath.setdefault(os.path.abspath(fname), []).append(fname)
+        paths = list(bypath)
+
+        found = {}
+        try:
+            conn = self._connect()
+            for i in range(0, len(paths), self.QUERY_SIZE):
+                chunk = paths[i:i + self.QUERY_SIZE]
+                query = "select path, size, mtime from files where path in (%s)" % \
+                        ','.join(['?'] * len(chunk))
+                for (path, size, mtime) in conn.execute(query, chunk):
+                    for fname in bypath[path]:
+                        found[fname] = (size, mtime)
+        except sqlite3.Error as err:
+            miscutils.fwdebug_print("WARN: Could not read file catalog %s, checking files "
+                                    "on disk instead: %s" % (self.dbfile, err))
+            self._unreadable = True
+            self.close()
+            return None
+        return found
+
+    def stat(self, fullnames):
+        """Return {fullname: (size, mtime) or None if file does not exist}.
+        """
+        fullnames = list(fullnames)
+        found = self._lookup(fullnames)
+        if found is None:
+            return self.fallback.stat(fullnames)
+        results = dict.fromkeys(fullnames)
+        results.update(found)
+        unknown = [fname for fname in results if results[fname] is None]
+        if unknown and self.verify_missing:
+            results.update(self.fallback.stat(unknown))
+        return results
+
+    def exists(self, fullnames):
+        """Return {fullname: whether file exists}.
+        """
+        fullnames = list(fullnames)
+        found = self._lookup(fullnames)
+        if found is None:
+            return self.fallback.exists(fullnames)
+        results = dict.fromkeys(fullnames, False)
+        for fname in found:
+            results[fname] = True
+        unknown = [fname for fname in results if not results[fname]]
+        if unknown and self.verify_missing:
+            results.update(self.fallback.exists(unknown))
+        return results
+
+    def add_files(self, fullnames):
+        """Record size and mtime of given files in the catalog and return how many.
+        """
+        rows = [(os.path.abspath(fname), info[0], info[1])
+                for (fname, info) in _stat_files(set(fullnames)).items() if info is not None]
+        conn = sqlite3.connect(self.dbfile)
+        try:
+            with conn:
+                conn.execute("create table if not exists files "
+                             "(path text primary key, size integer, mtime real)")
+                conn.executemany("insert or replace into files values (?, ?, ?)", rows)
+        finally:
+            conn.close()
+        self._unreadable = False
+        return len(rows)
+
+
+def get_file_backend(wrapsect):
+    """Return FileBackend configured by given wrapper section (may be None).
+    """
+    if wrapsect is None:
+        wrapsect = {}
+
+    workers = None
+    if intgdefs.IW_CHECK_FILES_WORKERS in wrapsect:
+        workers = int(wrapsect[intgdefs.IW_CHECK_FILES_WORKERS])
+    scandir_min = None
+    if intgdefs.IW_CHECK_FILES_SCANDIR_MIN in wrapsect:
+        scandir_min = int(wrapsect[intgdefs.IW_CHECK_FILES_SCANDIR_MIN])
+    scandir_ratio = None
+    if intgdefs.IW_CHECK_FILES_SCANDIR_RATIO in wrapsect:
+        scandir_ratio = int(wrapsect[intgdefs.IW_CHECK_FILES_SCANDIR_RATIO])
+    fsbackend = FilesystemBackend(workers, scandir_min, scandir_ratio)
+
+    name = wrapsect.get(intgdefs.IW_FILE_BACKEND, intgdefs.FILE_BACKEND_FILESYSTEM)
+    if name == intgdefs.FILE_BACKEND_FILESYSTEM:
+        return fsbackend
+    if name == intgdefs.FILE_BACKEND_CATALOG:
+        if intgdefs.IW_FILE_CATALOG not in wrapsect:
+            raise KeyError("Missing %s for %s file backend" %
+                           (intgdefs.IW_FILE_CATALOG, name))
+        return CatalogBackend(wrapsect[intgdefs.IW_FILE_CATALOG], fsbackend)
+
+    backend_class = miscutils.dynamically_load_class(name)
+    return backend_class(wrapsect)
+
+
 def get_cmd_hyphen(hyphen_type, cmd_option):
     """Determine correct hyphenation for command line argument.
     """
@@ -212,8 +503,8 @@ def get_list_fullnames(sect, modwcl):
     return listname, setfnames
 
 
-def get_file_fullnames(sect, filewcl, fullwcl):
-    """
+def get_file_fullnames(sect, filewcl, fullwcl, lookups=None):
+    """Return set of fullnames of file section (lookups is a shared LookupCache).
     """
     sectkeys = sect.split('.')
     sectname = sectkeys[1]
@@ -225,7 +516,8 @@ def get_file_fullnames(sect, filewcl, fullwcl):
     if sectname in filewcl:
         filesect = filewcl[sectname]
         if 'fullname' in filesect:
-            fnames = replfuncs.replace_vars(filesect['fullname'], fullwcl)[0]
+            fnames = replfuncs.replace_vars_batch([filesect['fullname']],
+                                                  lookups or fullwcl)[0][0]
             fnames = miscutils.fwsplit(fnames, ',')
             if miscutils.fwdebug_check(3, 'INTGMISC_DEBUG'):
                 miscutils.fwdebug_print("INFO: fullname = %s" % fnames)
@@ -245,6 +537,9 @@ def get_fullnames(modwcl, fullwcl, exsect=None):
     # intermediate files (output of 1 exec, but input for another exec
     # within same wrapper) are listed only with output files
 
+    # variables used by several file sections are only looked up once
+    lookups = replfuncs.LookupCache(fullwcl)
+
     # get output file names first so can exclude intermediate files from inputs
     outputs = {}
     allouts = set()
@@ -255,7 +550,8 @@ def get_fullnames(modwcl, fullwcl, exsect=None):
                 sectkeys = sect.split('.')
                 outset = None
                 if sectkeys[0] == intgdefs.IW_FILE_SECT:
-                    outset = get_file_fullnames(sect, modwcl[intgdefs.IW_FILE_SECT], fullwcl)
+                    outset = get_file_fullnames(sect, modwcl[intgdefs.IW_FILE_SECT],
+                                                fullwcl, lookups)
                 elif sectkeys[0] == intgdefs.IW_LIST_SECT:
                     listname, outset = get_list_fullnames(sect, modwcl)
                 else:
@@ -274,7 +570,8 @@ def get_fullnames(modwcl, fullwcl, exsect=None):
                 sectkeys = sect.split('.')
                 inset = None
                 if sectkeys[0] == intgdefs.IW_FILE_SECT:
-                    inset = get_file_fullnames(sect, modwcl[intgdefs.IW_FILE_SECT], fullwcl)
+                    inset = get_file_fullnames(sect, modwcl[intgdefs.IW_FILE_SECT],
+                                               fullwcl, lookups)
                 elif sectkeys[0] == intgdefs.IW_LIST_SECT:
                     listname, inset = get_list_fullnames(sect, modwcl)
                     #inset.add(listname)
@@ -4,11 +4,17 @@
 """
 
 import copy
+import concurrent.futures
+import functools
+import itertools
+import os
 import re
+from collections import OrderedDict
 from astropy.io import fits
 
 import despymisc.miscutils as miscutils
 import intgutils.intgdefs as intgdefs
+import intgutils.headerindex as headerindex
 import despyfitsutils.fitsutils as fitsutils
 
 
@@ -35,6 +41,450 @@ def replace_vars_single(instr, valdict, opts=None):
     return retval
 
 
+# opening of a variable, e.g. ${ or $opt{
+_VAR_OPEN_PAT = re.compile(r"(?i)\$(HEAD|opt|FUNC|)\{")
+_LITERAL_PAT = re.compile(r"[^$}]+")
+_VAR_TYPES = {'head': 'HEAD', 'opt': 'opt', 'func': 'FUNC', '': ''}
+
+
+@functools.lru_cache(maxsize=intgdefs.REPLACE_VARS_TEMPLATE_CACHE_SIZE)
+def compile_template(instr):
+    """Parse instr into tuple of literal strings and variables.
+    """
+    return _parse_template(instr, 0, False)[0]
+
+
+def _parse_template(instr, pos, inname):
+    """Return (tokens, end position) parsing instr from pos.
+    """
+    tokens = []
+    literal = []
+    while pos < len(instr):
+        char = instr[pos]
+        if char == '$':
+            match = _VAR_OPEN_PAT.match(instr, pos)
+            if match:
+                (nametokens, end) = _parse_template(instr, match.end(), True)
+                if end < len(instr) and nametokens:
+                    if literal:
+                        tokens.append(''.join(literal))
+                        literal = []
+                    tokens.append((_VAR_TYPES[match.group(1).lower()], match.group(), nametokens))
+                    pos = end + 1
+                    continue
+            literal.append(char)
+            pos += 1
+        elif char == '}':
+            if inname:
+                break
+            literal.append(char)
+            pos += 1
+        else:
+            match = _LITERAL_PAT.match(instr, pos)
+            literal.append(match.group())
+            pos = match.end()
+
+    if literal:
+        tokens.append(''.join(literal))
+    return tuple(tokens), pos
+
+
+class ValueMemo(dict):
+    """Rendered variable values, (type, name) -> (value, keep changes).
+    """
+
+    def __init__(self, shared=None):
+        dict.__init__(self)
+        self.shared = shared
+        self.volatile = 0            # count of header or function values rendered
+        self.volatile_keys = set()   # values that used them
+
+
+def render_template(tokens, valdict, opts, keep, instr, resolving=(), resolved=None):
+    """Return compiled template with all but function variables replaced.
+    """
+    if resolved is None:
+        resolved = ValueMemo()
+    out = []
+    for tok in tokens:
+        if isinstance(tok, str):
+            out.append(tok)
+            continue
+
+        (stype, opening, nametokens) = tok
+        var = render_template(nametokens, valdict, opts, keep, instr, resolving, resolved)
+        if stype == 'FUNC' or not var or '$' in var or '}' in var:
+            # not a simple variable (yet), leave for replace_vars' loops
+            out.append('%s%s}' % (opening, var))
+            continue
+
+        memokey = (stype, var)
+        if memokey in resolved:
+            (newval, keepchanges) = resolved[memokey]
+            if memokey in resolved.volatile_keys:
+                resolved.volatile += 1
+        elif resolved.shared is not None and memokey in resolved.shared:
+            (newval, keepchanges) = resolved.shared[memokey]
+        else:
+            nvolatile = resolved.volatile
+            keepchanges = {}
+            newval = _render_var(stype, var, valdict, opts, keepchanges, instr, resolving,
+                                 resolved)
+            resolved[memokey] = (newval, keepchanges)
+            if resolved.volatile != nvolatile:
+                resolved.volatile_keys.add(memokey)
+            elif resolved.shared is not None:
+                resolved.shared[memokey] = (newval, keepchanges)
+        keep.update(keepchanges)
+        out.append(newval)
+    return ''.join(out)
+
+
+def cycle_error(instr, cycle):
+    """Return exception for variables in cycle whose values refer back to themselves.
+    """
+    return Exception("Error: replace_vars function aborting from infinite loop '%s' (%s)" %
+                     (instr, ' -> '.join(cycle)))
+
+
+def _render_var(stype, var, valdict, opts, keep, instr, resolving, resolved):
+    """Return value of single variable like replace_vars_type.
+    """
+    parts = var.split(':')
+    newvar = parts[0]
+
+    if stype == 'HEAD':
+        (haskey, newval) = (True, get_head_value(newvar))
+        resolved.volatile += 1
+    elif hasattr(valdict, 'search'):
+        (haskey, newval) = valdict.search(newvar, opts)
+    else:
+        haskey = newvar in valdict
+        if haskey:
+            newval = valdict[newvar]
+
+    if miscutils.fwdebug_check(6, 'REPL_DEBUG'):
+        miscutils.fwdebug_print("\t newvar: %s " % (newvar))
+        miscutils.fwdebug_print("\t haskey: %s " % (haskey))
+        miscutils.fwdebug_print("\t newval: %s " % (newval if haskey else None))
+
+    if not haskey:
+        if stype != 'opt':
+            raise KeyError("Error: Could not find value for %s" % newvar)
+        # missing optional value so replace with empty string
+        return ''
+
+    newval = str(newval)
+    if newval.startswith('(') or ',' in newval:
+        # multiple value variable (e.g., band, ccdnum)
+        if opts is not None and 'expand' in opts and opts['expand']:
+            return '$LOOP{%s}' % var   # postpone for later expanding
+    elif len(parts) > 1:
+        prpat = "%%0%dd" % int(parts[1])
+        try:
+            keepval = newval
+            if '$' in newval:
+                if newvar in resolving:
+                    raise cycle_error(instr, resolving[resolving.index(newvar):] + (newvar,))
+                # values of the padded value's variables are not kept
+                keepval = render_template(compile_template(newval), valdict, opts, {}, instr,
+                                          resolving + (newvar,), resolved)
+                if '$' in keepval:
+                    keepval = replace_vars_single(newval, valdict, opts)
+                    resolved.volatile += 1   # may have called functions
+            keep[newvar] = keepval
+            return prpat % int(keepval)
+        except (TypeError, ValueError) as err:
+            miscutils.fwdebug_print("\tError = %s" % str(err))
+            miscutils.fwdebug_print("\tprpat = %s" % prpat)
+            miscutils.fwdebug_print("\tnewval = %s" % newval)
+            miscutils.fwdebug_print("\topts = %s" % opts)
+            raise err
+    else:
+        keep[newvar] = newval
+
+    if '$' not in newval:
+        return newval
+    if newvar in resolving:
+        raise cycle_error(instr, resolving[resolving.index(newvar):] + (newvar,))
+    return render_template(compile_template(newval), valdict, opts, keep, instr,
+                           resolving + (newvar,), resolved)
+
+
+def read_head_values(fname, keys):
+    """Return dict of header values (as strings) for keys opening fname once.
+    """
+    hdulist = fits.open(fname, 'readonly')
+    try:
+        values = {}
+        for key in keys:
+            if miscutils.fwdebug_check(0, 'REPL_DEBUG'):
+                miscutils.fwdebug_print("\tHEAD variable header key: %s " % (key))
+            values[key] = str(fitsutils.get_hdr_value(hdulist, key))
+    finally:
+        hdulist.close()
+    return values
+
+
+class HeaderCache(object):
+    """LRU cache of FITS header values for $HEAD{} variables.
+    """
+
+    def __init__(self, maxsize=intgdefs.HEAD_CACHE_SIZE, index=None,
+                 workers=intgdefs.HEAD_PREFETCH_WORKERS):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # path -> (size, mtime), {key: value}
+        self._index = index
+
+    @property
+    def index(self):
+        """Persistent HeaderIndex, by default named by environment.
+        """
+        if self._index is None:
+            self._index = headerindex.header_index_from_env() or False
+        return self._index
+
+    def clear(self):
+        """Remove all entries.
+        """
+        self._entries.clear()
+
+    def _lookup(self, fname, keys):
+        """Return (path, signature, entry, keys still to read) for fname.
+        """
+        fstat = os.stat(fname)
+        path = os.path.abspath(fname)
+        sig = (fstat.st_size, fstat.st_mtime_ns)
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != sig:
+            entry = (sig, {})
+
+        missing = [key for key in keys if key not in entry[1]]
+        if missing and self.index:
+            entry[1].update(self.index.get(path, sig, missing))
+            missing = [key for key in missing if key not in entry[1]]
+        return path, sig, entry, missing
+
+    def _save(self, path, sig, entry, values):
+        """Add newly read values to entry and make it the most recent.
+        """
+        if values:
+            entry[1].update(values)
+            if self.index:
+                self.index.put(path, sig, values)
+
+        if self.maxsize > 0:
+            self._entries[path] = entry
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_values(self, fname, keys):
+        """Return list of header values for keys in fname.
+        """
+        try:
+            (path, sig, entry, missing) = self._lookup(fname, keys)
+        except OSError:
+            # let fits.open report missing file as before
+            values = read_head_values(fname, keys)
+            return [values[key] for key in keys]
+
+        values = None
+        if missing:
+            self.misses += 1
+            values = read_head_values(fname, missing)
+        else:
+            self.hits += 1
+        self._save(path, sig, entry, values)
+        return [entry[1][key] for key in keys]
+
+    def prefetch(self, requests, workers=None):
+        """Read header values for {fname: set of keys}, opening each file once.
+        """
+        if workers is None:
+            workers = self.workers
+
+        toread = []
+        for fname, keys in requests.items():
+            try:
+                lookup = self._lookup(fname, sorted(keys))
+            except OSError as err:
+                _skip_prefetch(fname, err)
+                continue
+            if lookup[3]:
+                toread.append((fname, lookup))
+            else:
+                self.hits += 1
+                self._save(*lookup[:3], values=None)
+
+        if workers > 1 and len(toread) > 1:
+            with concurrent.futures.ThreadPoolExecutor(min(workers, len(toread))) as pool:
+                results = list(pool.map(_prefetch_read, toread))
+        else:
+            results = [_prefetch_read(info) for info in toread]
+
+        # index and entries are only changed by the calling thread
+        for ((fname, (path, sig, entry, _)), values) in zip(toread, results):
+            self.misses += 1
+            if isinstance(values, Exception):
+                _skip_prefetch(fname, values)
+            else:
+                self._save(path, sig, entry, values)
+
+
+def _prefetch_read(info):
+    """Return header values (or the exception) for HeaderCache.prefetch.
+    """
+    (fname, (_, _, _, missing)) = info
+    try:
+        return read_head_values(fname, missing)
+    except Exception as err:
+        return err
+
+
+def _skip_prefetch(fname, err):
+    """Report file whose headers could not be prefetched.
+    """
+    if miscutils.fwdebug_check(3, 'REPL_DEBUG'):
+        miscutils.fwdebug_print("\tSkipping HEAD prefetch for %s: %s" % (fname, err))
+
+
+# header values shared by all $HEAD{} variables in the process
+head_cache = HeaderCache()
+
+
+def get_head_value(newvar):
+    """Return value of $HEAD{fname,key1,...} variable (comma separated values).
+    """
+    if miscutils.fwdebug_check(0, 'REPL_DEBUG'):
+        miscutils.fwdebug_print("\tfound HEAD variable to expand: %s " % (newvar))
+
+    varlist = miscutils.fwsplit(newvar, ',')
+    fname = varlist[0]
+    if miscutils.fwdebug_check(0, 'REPL_DEBUG'):
+        miscutils.fwdebug_print("\tHEAD variable fname: %s " % (fname))
+    newval = head_cache.get_values(fname, varlist[1:])
+    miscutils.fwdebug_print("\tnewval: %s " % (newval))
+    newval = ','.join(newval)
+    return newval
+
+
+def find_head_requests(strings, valdict=None, requests=None):
+    """Return {fname: set of keys} for $HEAD{} variables in strings.
+    """
+    if requests is None:
+        requests = {}
+    for instr in strings:
+        if isinstance(instr, str) and '$' in instr:
+            _find_head_tokens(compile_template(instr), valdict, requests)
+    return requests
+
+
+def _find_head_tokens(tokens, valdict, requests):
+    """Add $HEAD{} variables in compiled template to requests.
+    """
+    for tok in tokens:
+        if isinstance(tok, str):
+            continue
+        (stype, _, nametokens) = tok
+        _find_head_tokens(nametokens, valdict, requests)
+        if stype != 'HEAD':
+            continue
+        if all(isinstance(ntok, str) for ntok in nametokens):
+            var = ''.join(nametokens)
+        elif valdict is None:
+            continue
+        else:
+            try:
+                var = render_template(nametokens, valdict, None, {}, '')
+            except Exception:
+                continue
+        varlist = miscutils.fwsplit(var.split(':')[0], ',')
+        requests.setdefault(varlist[0], set()).update(varlist[1:])
+
+
+def prefetch_head_values(strings, valdict=None, workers=None):
+    """Read all header values used by $HEAD{} in strings, one open per file.
+    """
+    head_cache.prefetch(find_head_requests(strings, valdict), workers)
+
+
+def prefetch_wcl_head_values(wcl, valdict=None, workers=None):
+    """Read all header values used by $HEAD{} anywhere in wcl, one open per file.
+    """
+    head_cache.prefetch(find_head_requests(_wcl_strings(wcl), valdict), workers)
+
+
+def _wcl_strings(wcl):
+    """Yield all string values in nested dictionaries.
+    """
+    for val in wcl.values():
+        if isinstance(val, dict):
+            for sval in _wcl_strings(val):
+                yield sval
+        elif isinstance(val, str):
+            yield val
+
+
+# loaded $FUNC{} callables and results of those declared pure
+_FUNC_LOADED = {}
+_FUNC_RESULTS = OrderedDict()
+
+
+def pure_func(func):
+    """Decorator declaring $FUNC{} function has no side effects.
+    """
+    func.pure = True
+    return func
+
+
+def load_func(funcinfo):
+    """Return callable named by funcinfo, loading it only once.
+    """
+    specf = _FUNC_LOADED.get(funcinfo)
+    if specf is None:
+        specf = miscutils.dynamically_load_class(funcinfo)
+        _FUNC_LOADED[funcinfo] = specf
+    return specf
+
+
+def clear_func_cache():
+    """Forget loaded $FUNC{} callables and saved results.
+    """
+    _FUNC_LOADED.clear()
+    _FUNC_RESULTS.clear()
+
+
+def call_func_var(newvar):
+    """Return value of $FUNC{module.func,arg1,...} variable.
+    """
+    if miscutils.fwdebug_check(0, 'REPL_DEBUG'):
+        miscutils.fwdebug_print("\tfound FUNC variable to expand: %s " % (newvar))
+
+    varlist = miscutils.fwsplit(newvar, ',')
+    funcinfo = varlist[0]
+    if miscutils.fwdebug_check(0, 'REPL_DEBUG'):
+        miscutils.fwdebug_print("\tFUNC info: %s " % (funcinfo))
+
+    specf = load_func(funcinfo)
+    if not getattr(specf, 'pure', False):
+        return specf(varlist[1:])
+
+    fkey = (funcinfo, tuple(varlist[1:]))
+    if fkey in _FUNC_RESULTS:
+        _FUNC_RESULTS.move_to_end(fkey)
+        return copy.deepcopy(_FUNC_RESULTS[fkey])
+
+    newval = specf(varlist[1:])
+    _FUNC_RESULTS[fkey] = copy.deepcopy(newval)
+    while len(_FUNC_RESULTS) > intgdefs.FUNC_RESULT_CACHE_SIZE:
+        _FUNC_RESULTS.popitem(last=False)
+    return newval
+
+
 def replace_vars_type(instr, valdict, required, stype, opts=None):
     """Search given string for variables of 1 type and replace.
     """
@@ -72,34 +522,10 @@ def replace_vars_type(instr, valdict, required, stype, opts=None):
 
         # find the variable's value
         if stype == 'HEAD':
-            if miscutils.fwdebug_check(0, 'REPL_DEBUG'):
-                miscutils.fwdebug_print("\tfound HEAD variable to expand: %s " % (newvar))
-
-            varlist = miscutils.fwsplit(newvar, ',')
-            fname = varlist[0]
-            if miscutils.fwdebug_check(0, 'REPL_DEBUG'):
-                miscutils.fwdebug_print("\tHEAD variable fname: %s " % (fname))
-            hdulist = fits.open(fname, 'readonly')
-            newval = []
-            for key in varlist[1:]:
-                if miscutils.fwdebug_check(0, 'REPL_DEBUG'):
-                    miscutils.fwdebug_print("\tHEAD variable header key: %s " % (key))
-                newval.append(str(fitsutils.get_hdr_value(hdulist, key)))
-            miscutils.fwdebug_print("\tnewval: %s " % (newval))
-            newval = ','.join(newval)
+            newval = get_head_value(newvar)
             haskey = True
-            hdulist.close()
         elif stype == 'FUNC':
-            if miscutils.fwdebug_check(0, 'REPL_DEBUG'):
-                miscutils.fwdebug_print("\tfound FUNC variable to expand: %s " % (newvar))
-
-            varlist = miscutils.fwsplit(newvar, ',')
-            funcinfo = varlist[0]
-            if miscutils.fwdebug_check(0, 'REPL_DEBUG'):
-                miscutils.fwdebug_print("\tFUNC info: %s " % (funcinfo))
-
-            specf = miscutils.dynamically_load_class(funcinfo)
-            newval = specf(varlist[1:])
+            newval = call_func_var(newvar)
             haskey = True
         elif hasattr(valdict, 'search'):
             (haskey, newval) = valdict.search(newvar, opts)
@@ -156,28 +582,135 @@ def replace_vars_type(instr, valdict, required, stype, opts=None):
     return (done, newstr, keep)
 
 
+_LOOP_PAT = re.compile(r"(?i)\$LOOP\{([^}]+)\}")
+
+
 def replace_vars_loop(valpair, valdict, opts=None):
     """Expand variables that have multiple values (e.g., band, ccdnum).
     """
-    #assert(isinstance(valdict, dict))
-
-    looptodo = [valpair]
     valuedone = []
     keepdone = []
-    maxtries = 100    # avoid infinite loop
-    count = 0
-    while len(looptodo) > 0 and count < maxtries:
-        count += 1
-        valpair = looptodo.pop()
+    for (valsub, keep) in iter_replace_vars_loop(valpair, valdict, opts):
+        valuedone.append(valsub)
+        keepdone.append(keep)
+
+    if miscutils.fwdebug_check(6, 'REPL_DEBUG'):
+        miscutils.fwdebug_print("\tEND OF WHILE LOOP = %s" % len(valuedone))
+    return valuedone, keepdone
+
+
+def iter_replace_vars_loop(valpair, valdict, opts=None):
+    """Yield (value, keep) for each combination of multiple valued variables.
+    """
+    splitinfo = _split_loop_vars(valpair[0])
+    loopvals = []
+    if splitinfo is not None:
+        (pieces, slots, loopvars) = splitinfo
+        for (newvar, parts) in loopvars:
+            if miscutils.fwdebug_check(6, 'REPL_DEBUG'):
+                miscutils.fwdebug_print("\tloop search: newvar= %s" % newvar)
+                miscutils.fwdebug_print("\tloop search: opts= %s" % opts)
+            (haskey, newval) = valdict.search(newvar, opts)
+            if not haskey:
+                return
+            nvals = miscutils.fwsplit(newval)
+            if not nvals:
+                return
+            if any(_LOOP_UNSAFE_PAT.search(nval) for nval in nvals):
+                # values could form new $LOOP{} variables
+                splitinfo = None
+                break
+            loopvals.append([(_pad_loop_value(nval, parts, opts), nval) for nval in nvals])
+
+    if splitinfo is None:
+        for result in _iter_replace_vars_loop_each(valpair, valdict, opts):
+            yield result
+        return
+
+    # outer variables reversed to match the todo stack used previously
+    order = [nvals[::-1] for nvals in loopvals[:-1]] + loopvals[-1:]
+    newvars = [newvar for (newvar, _) in loopvars]
+    for combo in itertools.product(*order):
+        keep = dict(valpair[1])
+        for (newvar, (_, kval)) in zip(newvars, combo):
+            keep[newvar] = kval
+        for (pos, varnum) in slots:
+            pieces[pos] = combo[varnum][0]
+        yield (''.join(pieces), keep)
+
+
+# values with these characters could form new variables, and names other
+# than these can match several spellings in the one at a time expansion
+_LOOP_UNSAFE_PAT = re.compile(r"[$\\{}]")
+_LOOP_NAME_PAT = re.compile(r"[\w:-]+$")
+
+
+def _split_loop_vars(instr):
+    """Return (pieces, slots, loopvars) splitting instr at $LOOP{} variables.
+    """
+    pieces = []
+    slots = []
+    loopvars = []
+    varnums = {}
+    pos = 0
+    for match in _LOOP_PAT.finditer(instr):
+        var = match.group(1)
+        if not match.group().startswith('$LOOP{') or not _LOOP_NAME_PAT.match(var):
+            return None
+        pieces.append(instr[pos:match.start()])
+        varkey = var.lower()
+        if varkey not in varnums:
+            varnums[varkey] = len(loopvars)
+            parts = var.split(':')
+            loopvars.append((parts[0], parts))
+        slots.append((len(pieces), varnums[varkey]))
+        pieces.append(None)
+        pos = match.end()
+    pieces.append(instr[pos:])
+
+    if not loopvars or any('$LOOP{' in piece for piece in pieces if piece is not None):
+        return None
+    return pieces, slots, loopvars
+
+
+def _pad_loop_value(nval, parts, opts):
+    """Return loop value zero padded to the width after the colon (if any).
+    """
+    if len(parts) > 1:
+        try:
+            prpat = "%%0%dd" % int(parts[1])
+            nval = prpat % int(nval)
+        except (TypeError, ValueError) as err:
+            miscutils.fwdebug_print("\tError = %s" % str(err))
+            miscutils.fwdebug_print("\tprpat = %s" % prpat)
+            miscutils.fwdebug_print("\tnval = %s" % nval)
+            miscutils.fwdebug_print("\topts = %s" % opts)
+            raise err
+    return nval
+
+
+def _iter_replace_vars_loop_each(valpair, valdict, opts):
+    """Yield (value, keep) expanding one $LOOP{} variable at a time.
+    """
+    # each entry also holds the loop variables already replaced in it, so a
+    # value that brings back one of them is an error instead of endless
+    looptodo = [(valpair[0], valpair[1], frozenset())]
+    ndone = 0
+    while len(looptodo) > 0:
+        (valstr, valkeep, replaced) = looptodo.pop()
+        valpair = (valstr, valkeep)
 
         if miscutils.fwdebug_check(3, 'REPL_DEBUG'):
             miscutils.fwdebug_print("looptodo: valpair[0] = %s" % valpair[0])
 
-        match_loop = re.search(r"(?i)\$LOOP\{([^}]+)\}", valpair[0])
+        match_loop = _LOOP_PAT.search(valpair[0])
 
         var = match_loop.group(1)
         parts = var.split(':')
         newvar = parts[0]
+        if var.lower() in replaced:
+            raise Exception("Error: replace_vars function aborting from infinite loop '%s'" %
+                            valpair[0])
 
         if miscutils.fwdebug_check(6, 'REPL_DEBUG'):
             miscutils.fwdebug_print("\tloop search: newvar= %s" % newvar)
@@ -195,16 +728,7 @@ def replace_vars_loop(valpair, valdict, opts=None):
                     miscutils.fwdebug_print("\tloop nv: nval=%s" % nval)
 
                 kval = nval    # save unpadded value for keep
-                if len(parts) > 1:
-                    try:
-                        prpat = "%%0%dd" % int(parts[1])
-                        nval = prpat % int(nval)
-                    except (TypeError, ValueError) as err:
-                        miscutils.fwdebug_print("\tError = %s" % str(err))
-                        miscutils.fwdebug_print("\tprpat = %s" % prpat)
-                        miscutils.fwdebug_print("\tnval = %s" % nval)
-                        miscutils.fwdebug_print("\topts = %s" % opts)
-                        raise err
+                nval = _pad_loop_value(nval, parts, opts)
 
                 if miscutils.fwdebug_check(6, 'REPL_DEBUG'):
                     miscutils.fwdebug_print("\tloop nv2: nval=%s" % nval)
@@ -218,23 +742,19 @@ def replace_vars_loop(valpair, valdict, opts=None):
                 if '$LOOP{' in valsub:
                     if miscutils.fwdebug_check(6, 'REPL_DEBUG'):
                         miscutils.fwdebug_print("\t\tputting back in todo list")
-                    looptodo.append((valsub, keep))
+                    looptodo.append((valsub, keep, replaced | {var.lower()}))
                 else:
-                    valuedone.append(valsub)
-                    keepdone.append(keep)
+                    ndone += 1
                     if miscutils.fwdebug_check(6, 'REPL_DEBUG'):
                         miscutils.fwdebug_print("\t\tputting back in done list")
+                    yield (valsub, keep)
         if miscutils.fwdebug_check(6, 'REPL_DEBUG'):
             miscutils.fwdebug_print("\tNumber in todo list = %s" % len(looptodo))
-            miscutils.fwdebug_print("\tNumber in done list = %s" % len(valuedone))
-    if miscutils.fwdebug_check(6, 'REPL_DEBUG'):
-        miscutils.fwdebug_print("\tEND OF WHILE LOOP = %s" % len(valuedone))
-
-    return valuedone, keepdone
+            miscutils.fwdebug_print("\tNumber in done list = %s" % ndone)
 
 
-def replace_vars(instr, valdict, opts=None):
-    """Replace variables in given instr.
+def _replace_vars_nonloop(instr, valdict, opts, shared=None):
+    """Return (string, keep, valdict) replacing all but $LOOP{} variables.
     """
     assert(isinstance(instr, str))
     #assert(isinstance(valdict, dict))
@@ -247,11 +767,22 @@ def replace_vars(instr, valdict, opts=None):
         #miscutils.fwdebug_print("\tvaldict = '%s'" % valdict)
         miscutils.fwdebug_print("\tinitial opts = '%s'" % opts)
 
+    # search a wcl through one scope instead of rebuilding it per variable
+    if hasattr(valdict, 'scope'):
+        valdict = valdict.scope(opts)
+
     keep = {}
 
+    # replace variables in one pass over the compiled string, the loops
+    # below only find variables formed by joining values with other text
+    tokens = compile_template(newstr)
+    if '$HEAD' in newstr.upper():
+        head_cache.prefetch(find_head_requests([newstr]))
+    newstr = render_template(tokens, valdict, opts, keep, instr, (), ValueMemo(shared))
+
     maxtries = 100    # avoid infinite loop
     count = 0
-    done = False
+    done = '$' not in newstr    # nothing left for the loops
     while not done and count < maxtries:
         count += 1
         done = True
@@ -279,7 +810,7 @@ def replace_vars(instr, valdict, opts=None):
     ##### FUNC
     maxtries = 100    # avoid infinite loop
     count = 0
-    done = False
+    done = '$' not in newstr
     while not done and count < maxtries:
         count += 1
         done = True
@@ -294,15 +825,43 @@ def replace_vars(instr, valdict, opts=None):
     if count >= maxtries:
         raise Exception("Error: replace_vars function aborting from infinite loop '%s'" % instr)
 
+    return newstr, keep, valdict
+
+
+def _loop_opts(opts):
+    """Return opts for looking up $LOOP{} variables (which are required).
+    """
+    if opts is not None:
+        opts['required'] = True
+    else:
+        opts = {'required': True, intgdefs.REPLACE_VARS: False}
+    return opts
+
+
+def iter_replace_vars(instr, valdict, opts=None):
+    """Yield (value, keep) for each value of instr after replacing variables.
+    """
+    (newstr, keep, valdict) = _replace_vars_nonloop(instr, valdict, opts)
+    found = False
+    if '$LOOP' in newstr:
+        for result in iter_replace_vars_loop((newstr, keep), valdict, _loop_opts(opts)):
+            found = True
+            yield result
+    if not found:
+        yield (newstr, keep)
+
+
+def replace_vars(instr, valdict, opts=None, shared=None):
+    """Replace variables in given instr (reusing values in shared dict if given).
+    """
+    (newstr, keep, valdict) = _replace_vars_nonloop(instr, valdict, opts, shared)
+
     #####
     valpair = (newstr, keep)
     valuedone = []
     keepdone = []
     if '$LOOP' in newstr:
-        if opts is not None:
-            opts['required'] = True
-        else:
-            opts = {'required': True, intgdefs.REPLACE_VARS: False}
+        opts = _loop_opts(opts)
         valuedone, keepdone = replace_vars_loop(valpair, valdict, opts)
 
     if miscutils.fwdebug_check(6, 'REPL_DEBUG'):
@@ -322,3 +881,78 @@ def replace_vars(instr, valdict, opts=None):
     if miscutils.fwdebug_check(5, 'REPL_DEBUG'):
         miscutils.fwdebug_print("END")
     return val2return
+
+
+class LookupCache(object):
+    """Variable lookups shared between many replace_vars calls.
+    """
+
+    def __init__(self, valdict, opts=None):
+        if hasattr(valdict, 'scope'):
+            valdict = valdict.scope(opts)
+        self.valdict = valdict
+        self.hits = 0
+        self.misses = 0
+        self._results = {}
+
+    def search(self, key, opts=None):
+        """Return (found, value) for key, searching valdict only once.
+        """
+        result = self._results.get(key)
+        if result is not None and (result[0] or not (opts and opts.get('required'))):
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        if hasattr(self.valdict, 'search'):
+            result = self.valdict.search(key, opts)
+        elif key in self.valdict:
+            result = (True, self.valdict[key])
+        else:
+            result = (False, '')
+        self._results[key] = result
+        return result
+
+
+def replace_vars_batch(strings, valdict, opts=None):
+    """Return replace_vars results for many strings sharing one lookup cache.
+    """
+    lookups = valdict
+    if not isinstance(lookups, LookupCache):
+        lookups = LookupCache(valdict, opts)
+    if isinstance(strings, dict):
+        headstrs = [instr for instr in _wcl_strings(strings) if _HEAD_PAT.search(instr)]
+    else:
+        headstrs = [instr for instr in strings if _HEAD_PAT.search(instr)]
+    if headstrs:
+        prefetch_head_values(headstrs, lookups)
+    return _replace_vars_batch(strings, lookups, opts)
+
+
+_HEAD_PAT = re.compile(r"(?i)\$HEAD\{")
+
+
+def _replace_vars_one(instr, lookups, opts):
+    """Return replace_vars result for one batch string.
+    """
+    if '$' not in instr:
+        return instr, {}
+    if opts is not None:
+        opts = copy.copy(opts)
+    return replace_vars(instr, lookups, opts)
+
+
+def _replace_vars_batch(strings, lookups, opts):
+    """Return replace_vars results for strings using lookups.
+    """
+    if isinstance(strings, dict):
+        results = OrderedDict()
+        for (key, val) in strings.items():
+            if isinstance(val, dict):
+                results[key] = _replace_vars_batch(val, lookups, opts)
+            elif isinstance(val, str):
+                results[key] = _replace_vars_one(val, lookups, opts)
+            else:
+                results[key] = val
+        return results
+    return [_replace_vars_one(instr, lookups, opts) for instr in strings]
@@ -10,30 +10,381 @@
 import sys
 import re
 import os
-from collections import OrderedDict
+from collections import OrderedDict, ChainMap
 from importlib import import_module
 import copy
+import gc
+import gzip
+import io
+import json
+import marshal
+import operator
+import locale
+import mmap
 
 
 import despymisc.miscutils as miscutils
 import intgutils.intgdefs as intgdefs
 import intgutils.replace_funcs as replfuncs
+import intgutils.wclcache as wclcache
+
+
+# Single combined pattern used by the token parser.  Alternatives are listed
+# in the same priority order as the line parser's individual searches and the
+# outer named group of the alternative that matched is match.lastgroup.
+_WCL_TOKEN_PAT = re.compile(r"(?P<include>.*?<<include (?P<include_file>\S+)>>)|"
+                            r"(?P<inclfunc>.*?<<inclfunc (?P<inclfunc_spec>[^>]+)>>)|"
+                            r"(?P<close>\s*</\s*(?P<close_key>\S+)\s*>\s*$)|"
+                            r"(?P<open>\s*<(?P<open_key>\S+)\s*(?P<open_sublabel>\S+)?>\s*$)|"
+                            r"(?P<keyval>\s*(?P<keyval_key>\S+)(?:\s*=\s*)(?P<keyval_val>.+)\s*$)|"
+                            r"(?P<keyval2>\s*(?P<keyval2_key>\S+)(?:\s+)(?P<keyval2_val>[^=].*)\s*$)")
+
+
+# Used by lazy reads to find lines that may open or close a section and
+# lines that continue on the next line.
+_LAZY_TAG_PAT = re.compile(rb"^[ \t\r\f\v]*<[^\n]*", re.MULTILINE)
+_LAZY_CONT_PAT = re.compile(rb"\\[ \t\r\f\v]*$", re.MULTILINE)
+
+
+def _tokenize_wcl(lines, linecnt=0):
+    """Yield (linecnt, line, match) for every non-empty logical line.
+    """
+    lineiter = iter(lines)
+    match = _WCL_TOKEN_PAT.match
+    for line in lineiter:
+        linecnt += 1
+        line = line.strip()
+        while line.endswith('\\'):
+            linecnt += 1
+            line = line[:-1] + next(lineiter, '').strip()
+
+        # delete comments
+        line = line.split('#')[0]
+
+        # skip comment line or empty line
+        if line:
+            yield linecnt, line, match(line)
+
+
+def _child(container, key):
+    """Return value of key in container (None if missing) without scoping rules.
+    """
+    if isinstance(container, OrderedDict):
+        return OrderedDict.get(container, key)
+    return container.get(key)
+
+
+def _disk_filename(in_file):
+    """Return name of file on disk that in_file reads from or None.
+    """
+    fname = getattr(in_file, 'name', None)
+    if isinstance(fname, str) and os.path.isfile(fname):
+        try:
+            if in_file.tell() == 0:
+                return fname
+        except (IOError, OSError, ValueError):
+            pass
+    return None
+
+
+def _scan_tag(sline, encoding):
+    """Return (kind, key, sublabel) for a stripped line starting with <.
+    """
+    if sline.endswith(b'>') and sline.isascii():
+        if sline.startswith(b'</'):
+            name = sline[2:-1]
+            if name and len(name.split()) == 1 and name.strip() == name:
+                return 'close', name.decode(encoding).lower(), None
+        else:
+            name = sline[1:-1]
+            if name and len(name.split()) == 1 and name.strip() == name:
+                return 'open', name.decode(encoding).lower(), None
+
+    match = _WCL_TOKEN_PAT.match(sline.decode(encoding))
+    if match is not None:
+        if match.lastgroup == 'open':
+            sublabel = match.group('open_sublabel')
+            if sublabel is not None:
+                sublabel = sublabel.lower()
+            return 'open', match.group('open_key').lower(), sublabel
+        if match.lastgroup == 'close':
+            return 'close', match.group('close_key').lower(), None
+    return None, None, None
+
+
+class _ChunkWriter(object):
+    """Collect output lines and write them to a file in large chunks.
+    """
+
+    CHUNK_LINES = 10000
+
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.binary = isinstance(out_file, (io.RawIOBase, io.BufferedIOBase))
+        self.lines = []
+        self._indents = {}
+
+    def indent(self, num):
+        """Return string of num spaces.
+        """
+        if num not in self._indents:
+            self._indents[num] = ' ' * num
+        return self._indents[num]
+
+    def check(self):
+        """Write collected lines if there are enough of them.
+        """
+        if len(self.lines) >= self.CHUNK_LINES:
+            self.flush()
+
+    def flush(self):
+        """Write all collected lines.
+        """
+        if self.lines:
+            text = '\n'.join(self.lines) + '\n'
+            del self.lines[:]
+            if self.binary:
+                text = text.encode('utf-8')
+            self.out_file.write(text)
+
+
+class LazySection(OrderedDict):
+    """Top-level section of a lazily read wcl file.
+    """
+
+    def __init__(self, path, filesig, key, ranges, encoding, filename, compact=False):
+        OrderedDict.__init__(self)
+        self._lazyinfo = (path, filesig, key, ranges, encoding, filename, compact)
+
+    def load(self):
+        """Parse section contents if not done yet.
+        """
+        if self._lazyinfo is None:
+            return
+        lazyinfo = self._lazyinfo
+        (path, filesig, key, ranges, encoding, filename, compact) = lazyinfo
+        self._lazyinfo = None
+
+        tmpwcl = WCL()
+        with open(path, 'rb') as wclfh:
+            fstat = os.fstat(wclfh.fileno())
+            if (fstat.st_size, fstat.st_mtime_ns) != filesig:
+                self._lazyinfo = lazyinfo
+                raise IOError("File %s changed since lazy read of section %s" % (path, key))
+            for (start, end, linecnt) in ranges:
+                wclfh.seek(start)
+                text = wclfh.read(end - start).decode(encoding)
+
+                # pad so any messages have the right line numbers
+                lines = ('\n' * (linecnt - 1) + text).split('\n')
+                state = _ParseState(tmpwcl, False, filename, intgdefs.WCL_PARSER_TOKEN, compact)
+                tmpwcl._parse_tokens(lines, state)
+                tmpwcl._parse_end(state)
+
+        for subkey, val in OrderedDict.__getitem__(tmpwcl, key).items():
+            OrderedDict.__setitem__(self, subkey, val)
+
+    def __reduce__(self):
+        return (OrderedDict, (list(self.items()),))
+
+
+def _lazy_method(name):
+    """Return method that loads a LazySection before calling OrderedDict's.
+    """
+    odmethod = getattr(OrderedDict, name)
+
+    def method(self, *args, **kwds):
+        self.load()
+        return odmethod(self, *args, **kwds)
+    method.__name__ = name
+    return method
+
+
+for _name in ['__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__',
+              '__reversed__', '__len__', '__eq__', '__ne__', '__repr__', '__or__', '__ior__',
+              'keys', 'items', 'values', 'get', 'copy', 'pop', 'popitem', 'setdefault',
+              'update', 'clear', 'move_to_end']:
+    setattr(LazySection, _name, _lazy_method(_name))
+
+
+class CompactSection(dict):
+    """Nested wcl section using less memory than an OrderedDict.
+    """
+    __slots__ = ()
+
+
+class _ParseState(object):
+    """Bookkeeping for a single call to WCL.read.
+    """
+
+    def __init__(self, top, cmdline, filename, parser, compact=False):
+        self.curr = top
+        self.stack = [top]  # to keep track of current sub-dictionary
+        self.stackkeys = ['__topwcl__']  # to keep track of current section key
+        self.cmdline = cmdline
+        self.filename = filename
+        self.parser = parser
+        self.deps = []      # files included, directly or not
+        self.envdeps = []   # (include name, resolved filename) using ~ or env vars
+        self.cacheable = True
+        self.compact = compact
+        self.section_type = CompactSection if compact else OrderedDict
+        self.strings = {}   # values already seen when compact, to share copies
+
+
+class WCLScope(object):
+    """Layered view of a wcl for scoped searches without copying.
+    """
+
+    def __init__(self, wcl, opt=None):
+        self.wcl = wcl
+        layers = []
+        if opt is not None and 'currentvals' in opt:
+            layers.append(opt['currentvals'])
+        if OrderedDict.__contains__(wcl, 'current'):
+            layers.append(OrderedDict.__getitem__(wcl, 'current'))
+        self.curvals = ChainMap(*layers)
+        self.searchobj = None
+        if opt and 'searchobj' in opt:
+            self.searchobj = opt['searchobj']
+
+    def lookup(self, key):
+        """Return (found, value) for lowercase non-dotted key.
+        """
+        curvals = self.curvals
+        if key in curvals:
+            return True, curvals[key]
+        if self.searchobj is not None and key in self.searchobj:
+            return True, self.searchobj[key]
+
+        wcl = self.wcl
+        for sect in wcl.search_order:
+            if "curr_" + sect in curvals and OrderedDict.__contains__(wcl, sect):
+                currkey = curvals['curr_' + sect]
+                sectdict = OrderedDict.__getitem__(wcl, sect)
+                if currkey in sectdict and key in sectdict[currkey]:
+                    return True, sectdict[currkey][key]
+
+        # lastly check global values
+        if OrderedDict.__contains__(wcl, key):
+            return True, OrderedDict.__getitem__(wcl, key)
+        return False, ''
+
+    def search(self, key, opt=None):
+        """Searches for key in this scope, opt only used for required.
+        """
+        if isinstance(key, str) and '.' in key:
+            return self.wcl.search(key, opt)
+
+        if hasattr(key, 'lower'):
+            key = key.lower()
+        (found, value) = self.lookup(key)
+        if not found and opt and 'required' in opt and opt['required']:
+            self.wcl._search_failed(key, opt, self.curvals)
+        return found, value
+
+
+class _RecordingScope(WCLScope):
+    """WCLScope remembering the keys searched, for caching getfull.
+    """
+
+    # values with these variables cannot be cached (files or functions)
+    _NOCACHE_PAT = re.compile(r"(?i)\$(HEAD|FUNC)\{")
+
+    def __init__(self, wcl, opt=None):
+        WCLScope.__init__(self, wcl, opt)
+        self.names = set()
+        self.lookups = {}   # lowercase key -> (found, value)
+        self.cacheable = True
+
+    def search(self, key, opt=None):
+        """Searches for key in this scope, remembering key and its result.
+        """
+        (found, value) = WCLScope.search(self, key, opt)
+        if isinstance(key, str):
+            key = key.lower()
+            self.names.update(key.split('.'))
+            self.lookups[key] = (found, value)
+        else:
+            self.cacheable = False
+        if isinstance(value, str) and self._NOCACHE_PAT.search(value):
+            self.cacheable = False
+        return found, value
+
+
+class WCLExpansion(object):
+    """View of a wcl with variables replaced, each resolved once per view.
+    """
+
+    def __init__(self, wcl, opts=None):
+        self.wcl = wcl
+        self.opts = opts
+        self.scope = WCLScope(wcl, opts)
+        self.values = {}   # variable values shared by all strings (see replfuncs.ValueMemo)
+
+    def expand(self, text):
+        """Return text with variables replaced like replace_vars(text, wcl, opts)[0].
+        """
+        opts = self.opts
+        if opts is not None:
+            opts = copy.copy(opts)
+        return replfuncs.replace_vars(str(text), self.scope, opts, self.values)[0]
+
+    def get(self, key, default=None):
+        """Return value of key (search rules) with variables replaced if string.
+        """
+        (found, value) = self.scope.search(key)
+        if not found:
+            return default
+        if isinstance(value, str):
+            value = self.expand(value)
+        return value
 
 
 class WCL(OrderedDict):
     """Base WCL class.
     """
 
+    # optional persistent cache of parsed wcl files (see wclcache.ParseCache)
+    parse_cache = wclcache.parse_cache_from_env()
+
+    # optional in-process cache of parsed include files (see wclcache.IncludeCache)
+    include_cache = wclcache.include_cache_from_env()
+
+    # cache of <<inclfunc>> results (see wclcache.InclfuncCache)
+    inclfunc_cache = wclcache.inclfunc_cache_from_env()
+
     def __init__(self, *args, **kwds):
         """Initialize with given wcl.
         """
-        OrderedDict.__init__(self, *args, **kwds)
+        # set before adding items since __setitem__ uses them
         self.search_order = OrderedDict()
+        self._has_shared = False   # whether holds wclcache.SharedSections
+        self._has_lazy = False     # whether holds LazySections
+        self._path_indexes = {}    # top key -> (section, {rest of key: (dict, last key)})
+        self.getfull_cache = wclcache.GetfullCache()
+        OrderedDict.__init__(self, *args, **kwds)
+
+    def scope(self, opt=None):
+        """Return WCLScope for repeated searches using the same opt.
+        """
+        return WCLScope(self, opt)
 
     def set_search_order(self, search_order):
         """Set the search order.
         """
         self.search_order = search_order
+        self.clear_lookup_caches()
+
+    def clear_lookup_caches(self, topkeys=None):
+        """Discard remembered dotted key paths and getfull results.
+        """
+        if topkeys is None:
+            self._path_indexes = {}
+            self.getfull_cache.clear()
+        else:
+            for key in topkeys:
+                self._path_indexes.pop(key, None)
 
     def __contains__(self, key, opts=None):
         """D.__contains__(k) -> True if D has a key k, else False.
@@ -49,9 +400,42 @@ class WCL(OrderedDict):
             value = default
         return value
 
-    #def __setitem__(self, key, val):
-    #    """ x.__setitem__(i, y) <==> x[i]=y """
-    #    OrderedDict.__setitem__(self, key, val)
+    def __setitem__(self, key, val):
+        """ x.__setitem__(i, y) <==> x[i]=y """
+        OrderedDict.__setitem__(self, key, val)
+        self._key_changed(key)
+
+    def __delitem__(self, key):
+        """ x.__delitem__(y) <==> del x[y] """
+        OrderedDict.__delitem__(self, key)
+        self._key_changed(key)
+
+    def pop(self, key, *args):
+        """Remove key and return its value (see OrderedDict.pop).
+        """
+        val = OrderedDict.pop(self, key, *args)
+        self._key_changed(key)
+        return val
+
+    def popitem(self, last=True):
+        """Remove and return a (key, value) pair (see OrderedDict.popitem).
+        """
+        (key, val) = OrderedDict.popitem(self, last)
+        self._key_changed(key)
+        return key, val
+
+    def clear(self):
+        """Remove all items.
+        """
+        OrderedDict.clear(self)
+        self.clear_lookup_caches()
+
+    def _key_changed(self, key):
+        """Discard cached lookups that used top-level key.
+        """
+        self._path_indexes.pop(key, None)
+        if hasattr(key, 'lower'):
+            self.getfull_cache.invalidate([key.lower()])
 
     def set(self, key, val):
         """Sets value of key in wcl, follows section notation.
@@ -63,9 +447,14 @@ class WCL(OrderedDict):
         valkey = subkeys.pop()
         wcldict = self
         for k in subkeys:
-            wcldict = OrderedDict.__getitem__(wcldict, k)
+            wcldict = wclcache.unshare_child(wcldict, k)
+            if isinstance(wcldict, LazySection):
+                wcldict.load()
 
-        OrderedDict.__setitem__(wcldict, valkey, val)
+        wcldict[valkey] = val
+        if subkeys:
+            # __setitem__ only sees changes to top-level keys
+            self._key_changed(subkeys[0])
 
         if miscutils.fwdebug_check(9, "WCL_DEBUG"):
             miscutils.fwdebug_print("END")
@@ -90,81 +479,74 @@ class WCL(OrderedDict):
         if isinstance(key, str) and '.' in key:
             if miscutils.fwdebug_check(8, 'WCL_DEBUG'):
                 miscutils.fwdebug_print("\t. in key '%s'" % key)
-
-            value = self
-            found = True
-            for k in key.split('.'):
-                if miscutils.fwdebug_check(8, 'WCL_DEBUG'):
-                    miscutils.fwdebug_print("\t\t partial key '%s'" % k)
-                if k in value:
-                    value = OrderedDict.__getitem__(value, k)
-                    if miscutils.fwdebug_check(8, 'WCL_DEBUG'):
-                        miscutils.fwdebug_print("\t\t next val '%s'" % value)
-                    found = True
-                else:
-                    value = ''
-                    found = False
-                    break
+            (found, value) = self._search_path(key)
 
         else:
-            # start with stored current values
-            if OrderedDict.__contains__(self, 'current'):
-                curvals = copy.deepcopy(OrderedDict.__getitem__(self, 'current'))
-            else:
-                curvals = OrderedDict()
-
-            # override with current values passed into function if given
-            if opt is not None and 'currentvals' in opt:
-                for ckey, cval in list(opt['currentvals'].items()):
-                    if miscutils.fwdebug_check(8, 'WCL_DEBUG'):
-                        miscutils.fwdebug_print("using specified curval %s = %s" % (ckey, cval))
-                    curvals[ckey] = cval
-
+            scope = WCLScope(self, opt)
             if miscutils.fwdebug_check(6, 'WCL_DEBUG'):
-                miscutils.fwdebug_print("curvals = %s" % curvals)
-            if key in curvals:
-                #print "found %s in curvals" % (key)
-                found = True
-                value = curvals[key]
-            elif opt and 'searchobj' in opt and key in opt['searchobj']:
-                found = True
-                value = opt['searchobj'][key]
-            else:
-                #print dir(self)
-                if hasattr(self, 'search_order'):
-                    for sect in self.search_order:
-                        #print "Searching section %s for key %s" % (sect, key)
-                        if "curr_" + sect in curvals:
-                            currkey = curvals['curr_'+sect]
-                            #print "\tcurrkey for section %s = %s" % (sect, currkey)
-                            if OrderedDict.__contains__(self, sect):
-                                sectdict = OrderedDict.__getitem__(self, sect)
-                                if currkey in sectdict:
-                                    if key in sectdict[currkey]:
-                                        found = True
-                                        value = sectdict[currkey][key]
-                                        break
-
-            # lastly check global values
-            if not found:
-                #print "\t%s not found, checking global values" % (key)
-                if OrderedDict.__contains__(self, key):
-                    found = True
-                    value = OrderedDict.__getitem__(self, key)
+                miscutils.fwdebug_print("curvals = %s" % dict(scope.curvals))
+            (found, value) = scope.lookup(key)
+            curvals = scope.curvals
 
         if not found and opt and 'required' in opt and opt['required']:
-            print("\n\nError: search for %s failed" % (key))
-            print("\tcurrent = ", OrderedDict.__getitem__(self, 'current'))
-            print("\topt = ", opt)
-            print("\tcurvals = ", curvals)
-            print("\n\n")
-            raise KeyError("Error: Search failed (%s)" % key)
+            self._search_failed(key, opt, curvals)
 
         if miscutils.fwdebug_check(8, 'WCL_DEBUG'):
             miscutils.fwdebug_print("\tEND: found=%s, value=%s" % (found, value))
 
         return found, value
 
+    def _search_path(self, key):
+        """Return (found, value) for exact dotted key.
+        """
+        (top, _, rest) = key.partition('.')
+        topdict = OrderedDict.get(self, top)
+        pathindex = self._path_indexes.get(top)
+        if pathindex is not None and pathindex[0] is topdict:
+            entry = pathindex[1].get(rest)
+            if entry is not None:
+                (containers, subkeys) = entry
+                for (i, subkey) in enumerate(subkeys[:-1]):
+                    if _child(containers[i], subkey) is not containers[i + 1]:
+                        break
+                else:
+                    if subkeys[-1] in containers[-1]:
+                        return True, containers[-1][subkeys[-1]]
+                # a section along the key was replaced, don't keep it alive
+                del pathindex[1][rest]
+
+        value = self
+        containers = []
+        for k in key.split('.'):
+            if miscutils.fwdebug_check(8, 'WCL_DEBUG'):
+                miscutils.fwdebug_print("\t\t partial key '%s'" % k)
+            if k in value:
+                containers.append(value)
+                value = OrderedDict.__getitem__(value, k)
+                if miscutils.fwdebug_check(8, 'WCL_DEBUG'):
+                    miscutils.fwdebug_print("\t\t next val '%s'" % value)
+            else:
+                return False, ''
+
+        if isinstance(topdict, dict):
+            if pathindex is None or pathindex[0] is not topdict:
+                pathindex = (topdict, {})
+                self._path_indexes[top] = pathindex
+            if len(pathindex[1]) < intgdefs.WCL_PATH_INDEX_SIZE:
+                # containers after the wcl itself, and the keys looked up in them
+                pathindex[1][rest] = (tuple(containers[1:]), tuple(rest.split('.')))
+        return True, value
+
+    def _search_failed(self, key, opt, curvals):
+        """Print search information and raise KeyError for failed required search.
+        """
+        print("\n\nError: search for %s failed" % (key))
+        print("\tcurrent = ", OrderedDict.__getitem__(self, 'current'))
+        print("\topt = ", opt)
+        print("\tcurvals = ", curvals if curvals is None else dict(curvals))
+        print("\n\n")
+        raise KeyError("Error: Search failed (%s)" % key)
+
     @classmethod
     def search_wcl_for_variables(cls, wcl):
         """Search the wcl for variables.
@@ -173,7 +555,7 @@ class WCL(OrderedDict):
             miscutils.fwdebug_print("BEG")
         usedvars = {}
         for key, val in list(wcl.items()):
-            if type(val) is dict or type(val) is OrderedDict:
+            if isinstance(val, dict):
                 uvars = cls.search_wcl_for_variables(val)
                 if uvars is not None:
                     usedvars.update(uvars)
@@ -193,7 +575,8 @@ class WCL(OrderedDict):
             miscutils.fwdebug_print("END")
         return usedvars
 
-    def write(self, out_file=None, sortit=False, indent=4):
+    def write(self, out_file=None, sortit=False, indent=4,
+              outtype=intgdefs.WCL_FORMAT_WCL):
         """Output a given dictionary in WCL format.
 
         Items within the same sub-dictionary are output in alphabetical order.
@@ -201,38 +584,264 @@ class WCL(OrderedDict):
         if out_file is None:
             out_file = sys.stdout
 
-        self._recurs_write_wcl(self, out_file, sortit, indent, 0)
+        if outtype == intgdefs.WCL_FORMAT_WCL:
+            writer = _ChunkWriter(out_file)
+            self._recurs_write_wcl(self, writer, sortit, indent, 0)
+            writer.flush()
+        elif outtype == intgdefs.WCL_FORMAT_JSON:
+            text = json.dumps(self._export_tree(self, sortit), separators=(',', ':'))
+            if isinstance(out_file, (io.RawIOBase, io.BufferedIOBase)):
+                text = text.encode('utf-8')
+            out_file.write(text)
+        elif outtype == intgdefs.WCL_FORMAT_MARSHAL:
+            if isinstance(out_file, io.TextIOBase):
+                out_file.flush()
+                out_file = out_file.buffer
+            marshal.dump(self._export_tree(self, sortit), out_file)
+            out_file.flush()
+        else:
+            raise ValueError('Invalid outtype (%s).  Valid outtypes: %s' %
+                             (outtype, ', '.join(intgdefs.WCL_FORMATS)))
+
+    def write_file(self, filename, sortit=False, indent=4,
+                   outtype=intgdefs.WCL_FORMAT_WCL):
+        """Output in given format to named file, gzip compressed if ending in .gz.
+        """
+        if filename.endswith('.gz'):
+            with gzip.open(filename, 'wb') as outfh:
+                self.write(outfh, sortit, indent, outtype)
+        elif outtype == intgdefs.WCL_FORMAT_MARSHAL:
+            with open(filename, 'wb') as outfh:
+                self.write(outfh, sortit, indent, outtype)
+        else:
+            with open(filename, 'w') as outfh:
+                self.write(outfh, sortit, indent, outtype)
 
-    def _recurs_write_wcl(self, wcl_dict, out_file, sortit, inc_indent, curr_indent):
+    @classmethod
+    def _export_tree(cls, wcl_dict, sortit):
+        """Convert to plain dicts with string values like those read from WCL text.
+        """
+        if sortit:
+            dictitems = sorted(wcl_dict.items(), key=operator.itemgetter(0))
+        else:
+            dictitems = wcl_dict.items()
+
+        tree = {}
+        for key, value in dictitems:
+            if isinstance(value, dict):
+                tree[key] = cls._export_tree(value, sortit and key != 'cmdline')
+            elif isinstance(value, str):
+                tree[key] = value
+            elif value is not None:
+                tree[key] = str(value)
+        return tree
+
+    def _recurs_write_wcl(self, wcl_dict, writer, sortit, inc_indent, curr_indent):
         """Internal recursive function to do actual WCL writing.
         """
         if len(wcl_dict) > 0:
             if sortit:
-                dictitems = sorted(wcl_dict.items())
+                dictitems = sorted(wcl_dict.items(), key=operator.itemgetter(0))
             else:
-                dictitems = list(wcl_dict.items())
+                dictitems = wcl_dict.items()
 
+            prefix = writer.indent(curr_indent)
+            lines = writer.lines
             for key, value in dictitems:
                 if isinstance(value, dict):
-                    print(' ' * curr_indent + "<" + str(key) + ">", file=out_file)
-                    save_sortit = sortit
-                    if key == 'cmdline':
-                        sortit = False    # don't sort cmdline section
-                    self._recurs_write_wcl(value, out_file, sortit, inc_indent,
-                                           curr_indent + inc_indent)
-                    sortit = save_sortit
-                    print(' ' * curr_indent + "</" + str(key) + ">", file=out_file)
+                    lines.append("%s<%s>" % (prefix, key))
+                    # don't sort cmdline section
+                    self._recurs_write_wcl(value, writer, sortit and key != 'cmdline',
+                                           inc_indent, curr_indent + inc_indent)
+                    lines.append("%s</%s>" % (prefix, key))
                 elif value is not None:
-                    print(' ' * curr_indent + "%s = %s" % (str(key), str(value)), file=out_file)
+                    lines.append("%s%s = %s" % (prefix, key, value))
+            writer.check()
 
-    def read(self, in_file=None, cmdline=False, filename='stdin'):
+    def read(self, in_file=None, cmdline=False, filename='stdin', parser=None, lazy=False,
+             intype=intgdefs.WCL_FORMAT_WCL, compact=False):
         """Reads WCL text from an open file object and returns a dictionary.
         """
-        curr = self
-        stack = []  # to keep track of current sub-dictionary
-        stackkeys = ['__topwcl__']  # to keep track of current section key
-        stack.append(curr) #
+        if in_file is None:
+            in_file = sys.stdin
 
+        if intype != intgdefs.WCL_FORMAT_WCL:
+            self._read_format(in_file, intype)
+        elif not (lazy and OrderedDict.__len__(self) == 0 and not cmdline and
+                  self._read_lazy_file(in_file, filename, compact)):
+            self._read(in_file, cmdline, filename, parser, compact)
+
+        self.clear_lookup_caches()
+
+    def _read_lazy_file(self, in_file, filename, compact):
+        """Try lazy read of in_file returning whether successful.
+        """
+        lazypath = _disk_filename(in_file)
+        if lazypath is None:
+            return False
+        encoding = getattr(in_file, 'encoding', None) or locale.getpreferredencoding(False)
+        return self._read_lazy(lazypath, encoding, filename, compact)
+
+    def _read_format(self, in_file, intype):
+        """Read tree written by write in json or marshal format.
+        """
+        if intype not in [intgdefs.WCL_FORMAT_JSON, intgdefs.WCL_FORMAT_MARSHAL]:
+            raise ValueError('Invalid intype (%s).  Valid intypes: %s' %
+                             (intype, ', '.join(intgdefs.WCL_FORMATS)))
+
+        # tree only holds dicts and strings so cannot have reference cycles,
+        # skip garbage collection passes while creating its many containers
+        gcenabled = gc.isenabled()
+        gc.disable()
+        try:
+            if intype == intgdefs.WCL_FORMAT_JSON:
+                tree = json.load(in_file, object_pairs_hook=OrderedDict)
+            else:
+                if isinstance(in_file, io.TextIOBase):
+                    in_file = in_file.buffer
+                tree = self._import_tree(marshal.loads(in_file.read()))
+        finally:
+            if gcenabled:
+                gc.enable()
+
+        if OrderedDict.__len__(self) == 0:
+            OrderedDict.update(self, tree)
+        else:
+            self.update(tree)
+
+    @classmethod
+    def _import_tree(cls, tree):
+        """Convert plain dicts to OrderedDicts.
+        """
+        odict = OrderedDict(tree)
+        for key, value in tree.items():
+            if isinstance(value, dict):
+                odict[key] = cls._import_tree(value)
+        return odict
+
+    def _read(self, in_file, cmdline, filename, parser, compact=False):
+        """Do actual reading for read, returning the parse state.
+        """
+        if parser is None:
+            parser = intgdefs.WCL_DEFAULT_PARSER
+
+        if self._has_lazy:
+            self.load_lazy()
+
+        # only a fresh parse into an empty wcl can be shared with other reads
+        # as includes may use variables from the existing wcl
+        cachepath = None
+        if self.parse_cache is not None and OrderedDict.__len__(self) == 0 and not compact:
+            cachepath = _disk_filename(in_file)
+
+        state = _ParseState(self, cmdline, filename, parser, compact)
+        if cachepath is not None:
+            cached = self.parse_cache.get(cachepath, cmdline)
+            if cached is not None:
+                (tree, state.deps, state.envdeps) = cached
+                OrderedDict.update(self, tree)
+                return state
+
+        if parser == intgdefs.WCL_PARSER_TOKEN:
+            self._read_tokens(in_file, state)
+        elif parser == intgdefs.WCL_PARSER_LINE:
+            self._read_lines(in_file, state)
+        else:
+            raise ValueError('Invalid WCL parser (%s).  Valid parsers: %s, %s' %
+                             (parser, intgdefs.WCL_PARSER_LINE, intgdefs.WCL_PARSER_TOKEN))
+
+        self._parse_end(state)
+
+        if cachepath is not None and state.cacheable:
+            self.parse_cache.put(cachepath, cmdline, OrderedDict(self),
+                                 state.deps, state.envdeps)
+        return state
+
+    def _read_lazy(self, path, encoding, filename, compact=False):
+        """Parse top-level values and index top-level sections by byte offset.
+        """
+        with open(path, 'rb') as wclfh:
+            fstat = os.fstat(wclfh.fileno())
+            if fstat.st_size == 0:
+                return False
+            buf = mmap.mmap(wclfh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if buf.find(b'<<incl') != -1 or _LAZY_CONT_PAT.search(buf) is not None:
+                return False
+
+            # find byte offsets of top-level sections using only tag lines
+            sections = OrderedDict()   # key -> [(start, end, first line)]
+            toplevel = []    # (start, end) of text to parse now
+            stack = []       # (key, opened as sublabel) of open sections
+            textstart = 0
+            (cntpos, linecnt) = (0, 0)
+            for match in _LAZY_TAG_PAT.finditer(buf):
+                (kind, key, sublabel) = _scan_tag(match.group().split(b'#')[0].strip(), encoding)
+                if kind == 'open':
+                    if stack and key == stack[-1][0]:
+                        return False
+                    if not stack:
+                        linecnt += buf[cntpos:match.start()].count(b'\n')
+                        cntpos = match.start()
+                        sections.setdefault(key, []).append((match.start(), None, linecnt + 1))
+                        toplevel.append((textstart, match.end(), 0))
+                    stack.append((key, False))
+                    if sublabel is not None:
+                        stack.append((sublabel, True))
+                elif kind == 'close':
+                    if stack and key == stack[-1][0]:
+                        stack.pop()
+                    elif len(stack) > 1 and stack[-1][1] and key == stack[-2][0]:
+                        stack.pop()
+                        stack.pop()
+                    else:
+                        return False
+                    if not stack:
+                        linecnt += buf[cntpos:match.start()].count(b'\n')
+                        cntpos = match.start()
+                        (start, _, firstline) = sections[key][-1]
+                        sections[key][-1] = (start, match.end(), firstline)
+                        textstart = match.start()
+                        toplevel.append((None, None, linecnt))
+            if stack:
+                return False
+            toplevel.append((textstart, len(buf), 0))
+
+            # parse top-level text, keeping the opening and closing line of
+            # each section so they are created in the right order
+            state = _ParseState(self, False, filename, intgdefs.WCL_PARSER_TOKEN, compact)
+            textlinecnt = 0
+            for (start, end, closelinecnt) in toplevel:
+                if start is None:
+                    textlinecnt = closelinecnt
+                    continue
+                text = buf[start:end].decode(encoding)
+                self._parse_tokens(text.split('\n'), state, textlinecnt)
+        finally:
+            buf.close()
+        self._parse_end(state)
+
+        filesig = (fstat.st_size, fstat.st_mtime_ns)
+        for key, ranges in sections.items():
+            if isinstance(OrderedDict.__getitem__(self, key), dict):
+                OrderedDict.__setitem__(self, key,
+                                        LazySection(path, filesig, key, ranges, encoding,
+                                                    filename, compact))
+                self._has_lazy = True
+        return True
+
+    def load_lazy(self):
+        """Parse all top-level sections not yet loaded by a lazy read.
+        """
+        for val in OrderedDict.values(self):
+            if isinstance(val, LazySection):
+                val.load()
+        self._has_lazy = False
+
+    def _read_lines(self, in_file, state):
+        """Parse WCL reading line by line and searching for each pattern in turn.
+        """
         line = in_file.readline()
         linecnt = 1
         while line:
@@ -249,16 +858,7 @@ class WCL(OrderedDict):
                 # handle includes
                 patmatch = re.search(r"<<include (\S+)>>", line)
                 if patmatch is not None:
-                    # replace wcl vars in filename
-                    filename2 = replfuncs.replace_vars_single(patmatch.group(1), self, None)
-
-                    # expand ~ and env vars in filename
-                    filename2 = os.path.expandvars(os.path.expanduser(filename2))
-
-                    wclobj2 = WCL()
-                    with open(filename2, "r") as wclfh:
-                        wclobj2.read(wclfh, cmdline, filename2)
-                    self.update(wclobj2)
+                    self._parse_include(state, patmatch.group(1))
                     line = in_file.readline()
                     linecnt += 1
                     continue
@@ -266,27 +866,7 @@ class WCL(OrderedDict):
                 # handle calls to external functions to get more information usually from db
                 patmatch = re.search(r"<<inclfunc ([^>]+)>>", line)
                 if patmatch is not None:
-                    if miscutils.fwdebug_check(9, "WCL_DEBUG"):
-                        miscutils.fwdebug_print("patmatch=%s" % patmatch.group(0))
-                    funcmatch = re.match('([^(]+)\(([^)]+)\)', patmatch.group(1))
-                    if funcmatch:
-                        if miscutils.fwdebug_check(9, "WCL_DEBUG"):
-                            miscutils.fwdebug_print("funcmatch keys=%s" % funcmatch.group(2))
-                            miscutils.fwdebug_print("funcmatch funcname=%s" % funcmatch.group(1))
-                        keys = miscutils.fwsplit(funcmatch.group(2), ',')
-                        argd = {}
-                        for k in keys:
-                            argd[k] = self.getfull(k)
-
-                        p, m = funcmatch.group(1).rsplit('.', 1)
-                        mod = import_module(p)
-                        get_info_func = getattr(mod, m)
-                        newinfo = get_info_func(argd)
-                        self.update(newinfo)
-                    else:
-                        raise SyntaxError('File %s Line %d - Error:  Invalid inclfunc %s' %
-                                          (filename, linecnt, patmatch))
-
+                    self._parse_inclfunc(state, linecnt, line, patmatch.group(1))
                     line = in_file.readline()
                     linecnt += 1
                     continue
@@ -294,46 +874,7 @@ class WCL(OrderedDict):
                 # handle group closing line <\string>
                 pat_match = re.search(r"^\s*</\s*(\S+)\s*>\s*$", line)
                 if pat_match is not None:
-                    key = pat_match.group(1).lower()
-                    if key == 'cmdline' or key == 'replace':
-                        cmdline = False
-                    sublabel = '__sublabel__' in curr
-                    if sublabel:
-                        del curr['__sublabel__']
-
-                    if key == stackkeys[len(stackkeys)-1]:
-                        stackkeys.pop()
-                        stack.pop()
-                        curr = stack[len(stack)-1]
-                    elif sublabel:
-                        if key == stackkeys[len(stackkeys) - 2]:
-                            stackkeys.pop()
-                            stack.pop()
-                            curr = stack[len(stack)-1]
-
-                            stackkeys.pop()
-                            stack.pop()
-                            curr = stack[len(stack)-1]
-                        else:
-                            print("******************************")
-                            print("Linecnt =", linecnt)
-                            print("Line =", line.strip())
-                            print("Closing Key =", key)
-                            self._print_stack(stackkeys, stack)
-
-                            raise SyntaxError('File %s Line %d - Error:  Invalid or missing section'
-                                              'close.   Got close for %s. Expecting close for %s.' %
-                                              (filename, linecnt, key, stackkeys[len(stackkeys) - 2]))
-                    else:
-                        print("******************************")
-                        print("Linecnt =", linecnt)
-                        print("Line =", line.strip())
-                        print("Closing Key =", key)
-                        self._print_stack(stackkeys, stack)
-                        raise SyntaxError('File %s Line %d - Error:  Invalid or missing section'
-                                          'close.   Got close for %s. Expecting close for %s.' %
-                                          (filename, linecnt, key, stackkeys[len(stackkeys) - 1]))
-
+                    self._parse_close(state, linecnt, line, pat_match.group(1))
                     line = in_file.readline()
                     linecnt += 1
                     continue
@@ -341,38 +882,7 @@ class WCL(OrderedDict):
                 # handle group opening line <key sublabel> or <key>
                 pat_match = re.search(r"^\s*<(\S+)\s*(\S+)?>\s*$", line)
                 if pat_match is not None:
-                    key = pat_match.group(1).lower()
-
-                    # check for case where missing / when closing section
-                    if key == stackkeys[-1]:
-                        print("******************************")
-                        print("Linecnt =", linecnt)
-                        print("Line =", line.strip())
-                        print("Opening Key =", key)
-                        self._print_stack(stackkeys, stack)
-                        raise SyntaxError('File %s Line %d - Error:  found '
-                                          'child section with same name (%s)' %
-                                          (filename, linecnt, key))
-
-                    stackkeys.append(key)
-
-                    if not key in curr:
-                        curr[key] = OrderedDict()
-
-                    stack.append(curr[key])
-                    curr = curr[key]
-
-                    if key == 'cmdline' or key == 'replace':
-                        cmdline = True
-
-                    if pat_match.group(2) is not None:
-                        val = pat_match.group(2).lower()
-                        stackkeys.append(val)
-                        if not val in curr:
-                            curr[val] = OrderedDict()
-                        curr[val]['__sublabel__'] = True
-                        stack.append(curr[val])
-                        curr = curr[val]
+                    self._parse_open(state, linecnt, line, pat_match.group(1), pat_match.group(2))
                     line = in_file.readline()
                     linecnt += 1
                     continue
@@ -381,10 +891,7 @@ class WCL(OrderedDict):
                 pat_key_val = r"^\s*(\S+)(\s*=\s*)(.+)\s*$"
                 pat_match = re.search(pat_key_val, line)
                 if pat_match is not None:
-                    key = pat_match.group(1)
-                    if not cmdline:
-                        key = key.lower()
-                    curr[key] = pat_match.group(3).strip()
+                    self._parse_keyval(state, pat_match.group(1), pat_match.group(3))
                     line = in_file.readline()
                     linecnt += 1
                     continue
@@ -392,10 +899,7 @@ class WCL(OrderedDict):
                 pat_key_val = r"^\s*(\S+)(\s+)([^=].*)\s*$"
                 pat_match = re.search(pat_key_val, line)
                 if pat_match is not None:
-                    key = pat_match.group(1)
-                    if not cmdline:
-                        key = key.lower()
-                    curr[key] = pat_match.group(3).strip()
+                    self._parse_keyval(state, pat_match.group(1), pat_match.group(3))
                     line = in_file.readline()
                     linecnt += 1
                     continue
@@ -407,17 +911,248 @@ class WCL(OrderedDict):
             line = in_file.readline()
             linecnt += 1
 
-        # done parsing input, should only be main dict in stack
-        if len(stack) != 1 or len(stackkeys) != 1:
+    def _read_tokens(self, in_file, state):
+        """Parse WCL tokenizing the whole buffer with one combined pattern.
+        """
+        lines = in_file.read().split('\n')
+        if lines[-1] == '':
+            lines.pop()   # trailing newline does not start another line
+        self._parse_tokens(lines, state)
+
+    def _parse_tokens(self, lines, state, linecnt=0):
+        """Parse given lines using the combined pattern.
+        """
+        for linecnt, line, match in _tokenize_wcl(lines, linecnt):
+            kind = None
+            if match is not None:
+                kind = match.lastgroup
+
+            if state.compact and (kind == 'keyval' or kind == 'keyval2'):
+                self._parse_keyval(state, match.group(kind + '_key'), match.group(kind + '_val'))
+            elif kind == 'keyval' or kind == 'keyval2':
+                key = match.group(kind + '_key')
+                if not state.cmdline:
+                    key = key.lower()
+                state.curr[key] = match.group(kind + '_val').strip()
+            elif kind == 'open':
+                self._parse_open(state, linecnt, line, match.group('open_key'),
+                                 match.group('open_sublabel'))
+            elif kind == 'close':
+                self._parse_close(state, linecnt, line, match.group('close_key'))
+            elif kind == 'include':
+                self._parse_include(state, match.group('include_file'))
+            elif kind == 'inclfunc':
+                self._parse_inclfunc(state, linecnt, line, match.group('inclfunc_spec'))
+            else:
+                print("Warning: Ignoring line #%d (did not match patterns):" % linecnt)
+                print(line)
+
+    def _parse_include(self, state, incfile):
+        """Read an included wcl file and merge it into this wcl.
+        """
+        # replace wcl vars in filename
+        filename2 = replfuncs.replace_vars_single(incfile, self, None)
+
+        # expand ~ and env vars in filename
+        filename3 = os.path.expandvars(os.path.expanduser(filename2))
+        if filename3 != filename2:
+            state.envdeps.append((filename2, filename3))
+        filename2 = filename3
+
+        cache = self.include_cache
+        cached = None
+        if cache is not None:
+            cached = cache.get(filename2, state.cmdline)
+
+        if cached is not None:
+            (wclobj2, deps2, envdeps2) = cached
+        else:
+            wclobj2 = WCL()
+            with open(filename2, "r") as wclfh:
+                state2 = wclobj2._read(wclfh, state.cmdline, filename2, state.parser)
+            (deps2, envdeps2) = (state2.deps, state2.envdeps)
+            if not state2.cacheable:
+                state.cacheable = False
+            elif cache is not None:
+                wclobj2 = cache.put(filename2, state.cmdline, wclobj2, deps2, envdeps2)
+
+        self.update(wclobj2, cache is not None and cache.share and
+                    isinstance(wclobj2, wclcache.SharedSection))
+
+        # remember what was included for validating cached parses
+        state.deps.append(filename2)
+        state.deps.extend(deps2)
+        state.envdeps.extend(envdeps2)
+
+    def _parse_inclfunc(self, state, linecnt, line, funcstr):
+        """Call external function (usually db lookup) and merge its results.
+        """
+        if miscutils.fwdebug_check(9, "WCL_DEBUG"):
+            miscutils.fwdebug_print("patmatch=<<inclfunc %s>>" % funcstr)
+
+        # results come from outside the files, so cannot cache the parse
+        state.cacheable = False
+        funcmatch = re.match(r'([^(]+)\(([^)]+)\)', funcstr)
+        if funcmatch:
+            if miscutils.fwdebug_check(9, "WCL_DEBUG"):
+                miscutils.fwdebug_print("funcmatch keys=%s" % funcmatch.group(2))
+                miscutils.fwdebug_print("funcmatch funcname=%s" % funcmatch.group(1))
+            keys = miscutils.fwsplit(funcmatch.group(2), ',')
+            argd = {}
+            for k in keys:
+                argd[k] = self.getfull(k)
+
+            found = False
+            if self.inclfunc_cache is not None:
+                (found, newinfo) = self.inclfunc_cache.get(funcmatch.group(1), argd)
+            if not found:
+                p, m = funcmatch.group(1).rsplit('.', 1)
+                mod = import_module(p)
+                get_info_func = getattr(mod, m)
+                newinfo = get_info_func(argd)
+                if self.inclfunc_cache is not None:
+                    self.inclfunc_cache.put(funcmatch.group(1), argd, newinfo)
+            self.update(newinfo)
+        else:
+            patmatch = re.search(r"<<inclfunc ([^>]+)>>", line)
+            raise SyntaxError('File %s Line %d - Error:  Invalid inclfunc %s' %
+                              (state.filename, linecnt, patmatch))
+
+    def _parse_close(self, state, linecnt, line, key):
+        """Handle group closing line </key>.
+        """
+        stackkeys = state.stackkeys
+        stack = state.stack
+
+        key = key.lower()
+        if key == 'cmdline' or key == 'replace':
+            state.cmdline = False
+        sublabel = '__sublabel__' in state.curr
+        if sublabel:
+            del state.curr['__sublabel__']
+
+        if key == stackkeys[len(stackkeys)-1]:
+            stackkeys.pop()
+            stack.pop()
+            state.curr = stack[len(stack)-1]
+        elif sublabel:
+            if key == stackkeys[len(stackkeys) - 2]:
+                stackkeys.pop()
+                stack.pop()
+                state.curr = stack[len(stack)-1]
+
+                stackkeys.pop()
+                stack.pop()
+                state.curr = stack[len(stack)-1]
+            else:
+                print("******************************")
+                print("Linecnt =", linecnt)
+                print("Line =", line.strip())
+                print("Closing Key =", key)
+                self._print_stack(stackkeys, stack)
+
+                raise SyntaxError('File %s Line %d - Error:  Invalid or missing section'
+                                  'close.   Got close for %s. Expecting close for %s.' %
+                                  (state.filename, linecnt, key, stackkeys[len(stackkeys) - 2]))
+        else:
+            print("******************************")
+            print("Linecnt =", linecnt)
+            print("Line =", line.strip())
+            print("Closing Key =", key)
+            self._print_stack(stackkeys, stack)
+            raise SyntaxError('File %s Line %d - Error:  Invalid or missing section'
+                              'close.   Got close for %s. Expecting close for %s.' %
+                              (state.filename, linecnt, key, stackkeys[len(stackkeys) - 1]))
+
+    def _parse_open(self, state, linecnt, line, key, sublabel):
+        """Handle group opening line <key sublabel> or <key>.
+        """
+        stackkeys = state.stackkeys
+        stack = state.stack
+        curr = state.curr
+
+        key = key.lower()
+
+        # check for case where missing / when closing section
+        if key == stackkeys[-1]:
+            print("******************************")
+            print("Linecnt =", linecnt)
+            print("Line =", line.strip())
+            print("Opening Key =", key)
             self._print_stack(stackkeys, stack)
-            print("File %s - Error parsing wcl_file." % filename)
+            raise SyntaxError('File %s Line %d - Error:  found '
+                              'child section with same name (%s)' %
+                              (state.filename, linecnt, key))
+
+        if state.compact:
+            key = sys.intern(key)
+        stackkeys.append(key)
+
+        if not key in curr:
+            curr[key] = state.section_type()
+        elif isinstance(curr[key], wclcache.SharedSection):
+            curr[key] = wclcache.unshare(curr[key])
+
+        stack.append(curr[key])
+        curr = curr[key]
+
+        if key == 'cmdline' or key == 'replace':
+            state.cmdline = True
+
+        if sublabel is not None:
+            val = sublabel.lower()
+            if state.compact:
+                val = sys.intern(val)
+            stackkeys.append(val)
+            if not val in curr:
+                curr[val] = state.section_type()
+            elif isinstance(curr[val], wclcache.SharedSection):
+                curr[val] = wclcache.unshare(curr[val])
+            curr[val]['__sublabel__'] = True
+            stack.append(curr[val])
+            curr = curr[val]
+
+        state.curr = curr
+
+    @classmethod
+    def _parse_keyval(cls, state, key, val):
+        """Handle key/val line.
+        """
+        if not state.cmdline:
+            key = key.lower()
+        val = val.strip()
+        if state.compact:
+            key = sys.intern(key)
+            val = state.strings.setdefault(val, val)
+        state.curr[key] = val
+
+    def _parse_end(self, state):
+        """Check that all sections were closed.
+        """
+        # done parsing input, should only be main dict in stack
+        if len(state.stack) != 1 or len(state.stackkeys) != 1:
+            self._print_stack(state.stackkeys, state.stack)
+            print("File %s - Error parsing wcl_file." % state.filename)
             print("Check that all sections have closing line.")
-            raise SyntaxError("File %s - missing section closing line." % filename)
+            raise SyntaxError("File %s - missing section closing line." % state.filename)
 
-    def update(self, udict):
+    def update(self, udict, share=False):
         """Update allowing for nested dictionaries.
         """
-        miscutils.updateOrderedDict(self, udict)
+        if share:
+            wclcache.shared_update(self, udict)
+            self._has_shared = True
+        else:
+            if self._has_shared:
+                wclcache.unshare_paths(self, udict)
+            miscutils.updateOrderedDict(self, udict)
+        for key in udict:
+            self._key_changed(key)
+
+    def expand_all(self, opts=None):
+        """Return WCLExpansion view of this wcl for one step (e.g., a command line).
+        """
+        return WCLExpansion(self, opts)
 
     def getfull(self, key, opts=None, default=None):
         """Return with variables replaced and expanded if string(s).
@@ -427,6 +1162,13 @@ class WCL(OrderedDict):
             miscutils.fwdebug_print("default - %s" % default)
             miscutils.fwdebug_print("opts - %s" % opts)
 
+        cachekey = self._getfull_cachekey(key, opts)
+        if cachekey is not None:
+            (hit, value) = self.getfull_cache.get(cachekey,
+                                                  lambda deps: self._lookups_unchanged(deps, opts))
+            if hit:
+                return value
+
         (found, value) = self.search(key, opts)
         if not found:
             value = default
@@ -444,12 +1186,59 @@ class WCL(OrderedDict):
                     miscutils.fwdebug_print("calling replace_vars value=%s, opts=%s" %
                                             (value, newopts))
 
-                (value, _) = replfuncs.replace_vars(value, self, newopts)
+                scope = _RecordingScope(self, newopts)
+                origvalue = value
+                cacheable = scope.cacheable and not scope._NOCACHE_PAT.search(value)
+                (value, _) = replfuncs.replace_vars(value, scope, newopts)
                 if len(value) == 1:
                     value = value[0]
 
+                if cachekey is not None and cacheable and scope.cacheable:
+                    scope.names.update(cachekey[0].split('.'))
+                    scope.lookups[cachekey[0]] = (found, origvalue)
+                    self.getfull_cache.put(cachekey, value, scope.names, scope.lookups)
+
         return value
 
+    def _lookups_unchanged(self, lookups, opts):
+        """Return whether searching each key gives the same (found, value).
+        """
+        scope = WCLScope(self, opts)
+        for (key, (found, value)) in lookups.items():
+            (newfound, newvalue) = scope.search(key)
+            if newfound != found or (newvalue is not value and newvalue != value):
+                return False
+        return True
+
+    def _getfull_cachekey(self, key, opts):
+        """Return hashable key for caching getfull result or None if not cacheable.
+        """
+        if not isinstance(key, str):
+            return None
+
+        optsig = None
+        if opts:
+            optsig = []
+            for okey, oval in opts.items():
+                if okey == 'currentvals' and isinstance(oval, dict):
+                    oval = tuple(oval.items())
+                elif isinstance(oval, dict):   # e.g., searchobj
+                    return None
+                optsig.append((okey, oval))
+            optsig = tuple(sorted(optsig))
+
+        cursig = None
+        current = OrderedDict.get(self, 'current')
+        if isinstance(current, dict):
+            cursig = tuple(current.items())
+
+        cachekey = (key.lower(), optsig, cursig)
+        try:
+            hash(cachekey)
+        except TypeError:
+            return None
+        return cachekey
+
     @classmethod
     def _print_stack(cls, stackkeys, stack):
         """Print stackkeys and stack for debugging.
@@ -468,6 +1257,111 @@ class WCL(OrderedDict):
         print("\n\n")
 
 
+def iterparse(in_file, cmdline=False, filename='stdin'):
+    """Yield parse events for WCL text without building the tree.
+    """
+    # events: ('start', key, sublabel), ('end', key, sublabel) (closes two
+    # levels if sublabel is not None), ('keyval', key, value), ('include', name)
+    # and ('inclfunc', funcspec); includes and inclfuncs are not processed
+    stack = [('__topwcl__', False)]   # (key, opened as sublabel)
+    for linecnt, line, match in _tokenize_wcl(in_file):
+        kind = None
+        if match is not None:
+            kind = match.lastgroup
+
+        if kind == 'keyval' or kind == 'keyval2':
+            key = match.group(kind + '_key')
+            if not cmdline:
+                key = key.lower()
+            yield ('keyval', key, match.group(kind + '_val').strip())
+        elif kind == 'open':
+            key = match.group('open_key').lower()
+            if key == stack[-1][0]:
+                raise SyntaxError('File %s Line %d - Error:  found '
+                                  'child section with same name (%s)' %
+                                  (filename, linecnt, key))
+            stack.append((key, False))
+            if key == 'cmdline' or key == 'replace':
+                cmdline = True
+            sublabel = match.group('open_sublabel')
+            if sublabel is not None:
+                sublabel = sublabel.lower()
+                stack.append((sublabel, True))
+            yield ('start', key, sublabel)
+        elif kind == 'close':
+            key = match.group('close_key').lower()
+            if key == 'cmdline' or key == 'replace':
+                cmdline = False
+            (topkey, sublabel) = stack[-1]
+            if key == topkey:
+                stack.pop()
+                yield ('end', key, None)
+            elif sublabel and key == stack[-2][0]:
+                stack.pop()
+                stack.pop()
+                yield ('end', key, topkey)
+            else:
+                if sublabel:
+                    expect = stack[-2][0]
+                else:
+                    expect = topkey
+                raise SyntaxError('File %s Line %d - Error:  Invalid or missing section'
+                                  'close.   Got close for %s. Expecting close for %s.' %
+                                  (filename, linecnt, key, expect))
+        elif kind == 'include':
+            yield ('include', match.group('include_file'))
+        elif kind == 'inclfunc':
+            yield ('inclfunc', match.group('inclfunc_spec'))
+        else:
+            print("Warning: Ignoring line #%d (did not match patterns):" % linecnt)
+            print(line)
+
+    if len(stack) != 1:
+        print("File %s - Error parsing wcl_file." % filename)
+        print("Check that all sections have closing line.")
+        raise SyntaxError("File %s - missing section closing line." % filename)
+
+
+def read_sections(in_file, sections, cmdline=False, filename='stdin'):
+    """Return WCL holding only the given sections of the WCL text.
+    """
+    wanted = set(tuple(sect.lower().split('.')) for sect in sections)
+
+    result = WCL()
+    path = []      # keys of all open levels
+    nodes = []     # matching nodes in result, None if level not kept
+    curr = None    # node receiving values, None if current level not kept
+    for event in iterparse(in_file, cmdline, filename):
+        if event[0] == 'keyval':
+            if curr is not None:
+                curr[event[1]] = event[2]
+            elif tuple(path + [event[1]]) in wanted:
+                # requested path is a single value
+                parent = result
+                for k in path:
+                    parent = parent.setdefault(k, OrderedDict())
+                parent[event[1]] = event[2]
+        elif event[0] == 'start':
+            for key in event[1:]:
+                if key is None:
+                    continue
+                path.append(key)
+                if curr is None and tuple(path) in wanted:
+                    curr = result
+                    for k in path:
+                        curr = curr.setdefault(k, OrderedDict())
+                elif curr is not None:
+                    curr = curr.setdefault(key, OrderedDict())
+                nodes.append(curr)
+        elif event[0] == 'end':
+            for _ in range(2 if event[2] is not None else 1):
+                path.pop()
+                nodes.pop()
+            curr = nodes[-1] if nodes else None
+
+    return result
+
+
 def run_test():
     """Calls read and write routines as a test.
     """
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+
+"""Caches used when reading WCL files.
+"""
+
+import os
+import copy
+import time
+import hashlib
+import pickle
+import tempfile
+from collections import OrderedDict
+
+import despymisc.miscutils as miscutils
+import intgutils.intgdefs as intgdefs
+
+
+def file_signature(path):
+    """Return (path, size, mtime, content hash) for given file.
+    """
+    fstat = os.stat(path)
+    return (path, fstat.st_size, fstat.st_mtime_ns, file_hash(path))
+
+
+def file_hash(path):
+    """Return hex sha1 of the contents of given file.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as infh:
+        for chunk in iter(lambda: infh.read(1048576), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def signature_matches(sig):
+    """Check whether file still matches given (path, size, mtime, hash).
+    """
+    (path, size, mtime, chash) = sig
+    try:
+        fstat = os.stat(path)
+        if fstat.st_size != size:
+            return False
+        if fstat.st_mtime_ns == mtime:
+            return True
+        return file_hash(path) == chash
+    except (IOError, OSError):
+        return False
+
+
+def load_private_pickle(path):
+    """Return object pickled in path, which must be private to this user.
+    """
+    with open(path, 'rb') as infh:
+        fstat = os.fstat(infh.fileno())
+        if fstat.st_uid != os.getuid() or fstat.st_mode & 0o022:
+            raise pickle.UnpicklingError("Refusing to load %s not private to this user" % path)
+        return pickle.load(infh)
+
+
+class ParseCache(object):
+    """Persistent on-disk cache of parsed WCL trees.
+    """
+
+    VERSION = 1
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_filename(self, path, cmdline):
+        """Return name of file holding cache entry for given wcl file.
+        """
+        key = "%s|%s|%s" % (self.VERSION, os.path.abspath(path), bool(cmdline))
+        return os.path.join(self.cachedir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+
+    def get(self, path, cmdline):
+        """Return (tree, deps, envdeps) for given wcl file or None if not valid.
+        """
+        entry = None
+        try:
+            entry = load_private_pickle(self._entry_filename(path, cmdline))
+        except (IOError, OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            entry = None
+
+        if entry is not None:
+            if entry['version'] != self.VERSION or entry['path'] != os.path.abspath(path):
+                entry = None
+            elif not all(signature_matches(sig) for sig in entry['deps']):
+                entry = None
+            else:
+                for (spec, resolved) in entry['envdeps']:
+                    if os.path.expandvars(os.path.expanduser(spec)) != resolved:
+                        entry = None
+                        break
+
+        if entry is None:
+            self.misses += 1
+            if miscutils.fwdebug_check(3, "WCL_DEBUG"):
+                miscutils.fwdebug_print("parse cache miss for %s" % path)
+            return None
+
+        self.hits += 1
+        if miscutils.fwdebug_check(3, "WCL_DEBUG"):
+            miscutils.fwdebug_print("parse cache hit for %s" % path)
+        return entry['tree'], [sig[0] for sig in entry['deps'][1:]], entry['envdeps']
+
+    def put(self, path, cmdline, tree, deps, envdeps):
+        """Save parsed tree for given wcl file and the files it included.
+        """
+        try:
+            sigs = [file_signature(dep) for dep in [path] + deps]
+            entry = {'version': self.VERSION,
+                     'path': os.path.abspath(path),
+                     'deps': sigs,
+                     'envdeps': envdeps,
+                     'tree': tree}
+
+            miscutils.coremakedirs(self.cachedir)
+            (tmpfd, tmpname) = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+            with os.fdopen(tmpfd, 'wb') as entryfh:
+                pickle.dump(entry, entryfh, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self._entry_filename(path, cmdline))
+        except (IOError, OSError, pickle.PicklingError) as err:
+            # cache is only an optimization, so never fail the read
+            if miscutils.fwdebug_check(1, "WCL_DEBUG"):
+                miscutils.fwdebug_print("Could not save parse cache entry for %s: %s" %
+                                        (path, err))
+
+
+def include_cache_from_env():
+    """Return sharing IncludeCache sized from environment or None if not set.
+    """
+    size = os.environ.get(intgdefs.WCL_INCLUDE_CACHE_ENV)
+    if size:
+        return IncludeCache(int(size), share=True)
+    return None
+
+
+def parse_cache_from_env():
+    """Return ParseCache using directory from environment or None if not set.
+    """
+    cachedir = os.environ.get(intgdefs.WCL_PARSE_CACHE_ENV)
+    if cachedir:
+        return ParseCache(cachedir)
+    return None
+
+
+class SharedSection(OrderedDict):
+    """Read-only section shared between WCL trees (copy-on-write).
+    """
+
+    def _readonly(self, *args, **kwds):
+        """Refuse to modify shared section.
+        """
+        raise TypeError("Cannot modify shared wcl section.  Use WCL.set instead.")
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+    move_to_end = _readonly
+
+    def __reduce__(self):
+        return (OrderedDict, (list(self.items()),))
+
+
+def freeze_tree(tree):
+    """Return copy of tree made of SharedSections.
+    """
+    frozen = SharedSection()
+    for key, val in tree.items():
+        if isinstance(val, dict):
+            val = freeze_tree(val)
+        OrderedDict.__setitem__(frozen, key, val)
+    return frozen
+
+
+def unshare(section):
+    """Return private shallow copy of a shared section.
+    """
+    return OrderedDict(section.items())
+
+
+def unshare_child(parent, key):
+    """Make sure parent[key] is not shared, returning it.
+    """
+    child = OrderedDict.__getitem__(parent, key)
+    if isinstance(child, SharedSection):
+        child = unshare(child)
+        parent[key] = child
+    return child
+
+
+def unshare_paths(tree, udict):
+    """Unshare every section of tree that updating with udict will modify.
+    """
+    for key, val in udict.items():
+        if isinstance(val, dict) and OrderedDict.__contains__(tree, key) and \
+                isinstance(OrderedDict.__getitem__(tree, key), dict):
+            unshare_paths(unshare_child(tree, key), val)
+
+
+def shared_update(tree, udict):
+    """Merge udict into tree sharing instead of copying sections new to tree.
+    """
+    for key, val in udict.items():
+        if isinstance(val, dict) and OrderedDict.__contains__(tree, key) and \
+                isinstance(OrderedDict.__getitem__(tree, key), dict):
+            shared_update(unshare_child(tree, key), val)
+        elif isinstance(val, dict) and not isinstance(val, SharedSection):
+            tree[key] = freeze_tree(val)
+        else:
+            tree[key] = val
+
+
+class IncludeCache(object):
+    """In-process LRU cache of parsed include files.
+    """
+
+    def __init__(self, maxsize=intgdefs.WCL_INCLUDE_CACHE_SIZE, share=False):
+        self.maxsize = maxsize
+        self.share = share
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def clear(self):
+        """Remove all entries.
+        """
+        self._entries.clear()
+
+    def get(self, path, cmdline):
+        """Return (tree, deps, envdeps) for given include file or None.
+        """
+        key = (os.path.abspath(path), bool(cmdline))
+        entry = self._entries.get(key)
+        if entry is not None:
+            (tree, deps, envdeps, stats) = entry
+            try:
+                valid = all(_stat_key(dep) == dstat for (dep, dstat) in stats)
+            except (IOError, OSError):
+                valid = False
+            if valid:
+                for (spec, resolved) in envdeps:
+                    if os.path.expandvars(os.path.expanduser(spec)) != resolved:
+                        valid = False
+                        break
+            if valid:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return tree, deps, envdeps
+            del self._entries[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, path, cmdline, tree, deps, envdeps):
+        """Save parsed include returning the tree to merge (frozen if shared).
+        """
+        if self.maxsize <= 0:
+            return tree
+        try:
+            stats = [(dep, _stat_key(dep)) for dep in [path] + deps]
+        except (IOError, OSError):
+            return tree
+        if self.share:
+            tree = freeze_tree(tree)
+        key = (os.path.abspath(path), bool(cmdline))
+        self._entries[key] = (tree, list(deps), list(envdeps), stats)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return tree
+
+
+class GetfullCache(object):
+    """Cache of WCL.getfull results.
+    """
+
+    def __init__(self, maxsize=intgdefs.WCL_GETFULL_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # cache key -> (result, names, deps)
+        self._bynames = {}              # name -> set of cache keys
+
+    def clear(self):
+        """Remove all entries.
+        """
+        self._entries.clear()
+        self._bynames.clear()
+
+    def get(self, cachekey, isvalid=None):
+        """Return (found, result) for given cache key.
+        """
+        entry = self._entries.get(cachekey)
+        if entry is not None and entry[2] is not None and isvalid is not None and \
+           not isvalid(entry[2]):
+            self._remove(cachekey)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        result = entry[0]
+        if isinstance(result, list):
+            result = list(result)
+        return True, result
+
+    def put(self, cachekey, result, names, deps=None):
+        """Save result expanded using given key names and lookups (deps).
+        """
+        if self.maxsize <= 0:
+            return
+        if cachekey in self._entries:
+            self._remove(cachekey)
+        if isinstance(result, list):
+            result = list(result)
+        self._entries[cachekey] = (result, names, deps)
+        for name in names:
+            self._bynames.setdefault(name, set()).add(cachekey)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, names):
+        """Discard results that used any of the given key names.
+        """
+        for name in names:
+            for cachekey in list(self._bynames.get(name, ())):
+                self._remove(cachekey)
+
+    def _remove(self, cachekey):
+        """Remove entry from both mappings.
+        """
+        (_, names, _) = self._entries.pop(cachekey)
+        for name in names:
+            cachekeys = self._bynames.get(name)
+            if cachekeys is not None:
+                cachekeys.discard(cachekey)
+                if not cachekeys:
+                    del self._bynames[name]
+
+
+def _stat_key(path):
+    """Return (size, mtime) used to check that a file has not changed.
+    """
+    fstat = os.stat(path)
+    return (fstat.st_size, fstat.st_mtime_ns)
+
+
+class InclfuncCache(object):
+    """Cache of <<inclfunc>> results keyed on function and argument values.
+    """
+
+    def __init__(self, cachedir=None, ttl=intgdefs.WCL_INCLFUNC_CACHE_TTL):
+        self.cachedir = cachedir
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+
+    def clear(self):
+        """Remove all in-memory entries.
+        """
+        self._entries.clear()
+
+    @classmethod
+    def _key(cls, funcname, argd):
+        """Return string identifying call of funcname with given arguments.
+        """
+        return "%s(%s)" % (funcname, repr(sorted(argd.items())))
+
+    def _expired(self, savetime):
+        """Check whether entry saved at given time is too old.
+        """
+        return self.ttl is not None and time.time() - savetime > self.ttl
+
+    def _entry_filename(self, key):
+        """Return name of file holding cache entry for given call.
+        """
+        return os.path.join(self.cachedir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+
+    def get(self, funcname, argd):
+        """Return (found, result) for calling funcname with argd.
+        """
+        key = self._key(funcname, argd)
+        entry = self._entries.get(key)
+        if entry is not None and self._expired(entry[0]):
+            del self._entries[key]
+            entry = None
+
+        if entry is None and self.cachedir is not None:
+            try:
+                entry = load_private_pickle(self._entry_filename(key))
+                if entry[1] != key or self._expired(entry[0]):
+                    entry = None
+                else:
+                    entry = (entry[0], entry[2])
+                    self._entries[key] = entry
+            except (IOError, OSError, EOFError, pickle.UnpicklingError, AttributeError,
+                    ValueError, IndexError, TypeError):
+                entry = None
+
+        if entry is None:
+            self.misses += 1
+            if miscutils.fwdebug_check(3, "WCL_DEBUG"):
+                miscutils.fwdebug_print("inclfunc cache miss for %s" % key)
+            return False, None
+
+        self.hits += 1
+        if miscutils.fwdebug_check(3, "WCL_DEBUG"):
+            miscutils.fwdebug_print("inclfunc cache hit for %s" % key)
+        return True, copy.deepcopy(entry[1])
+
+    def put(self, funcname, argd, result):
+        """Save result of calling funcname with argd.
+        """
+        key = self._key(funcname, argd)
+        savetime = time.time()
+        self._entries[key] = (savetime, copy.deepcopy(result))
+
+        if self.cachedir is not None:
+            try:
+                miscutils.coremakedirs(self.cachedir)
+                (tmpfd, tmpname) = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+                with os.fdopen(tmpfd, 'wb') as entryfh:
+                    pickle.dump((savetime, key, result), entryfh, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmpname, self._entry_filename(key))
+            except (IOError, OSError, pickle.PicklingError) as err:
+                if miscutils.fwdebug_check(1, "WCL_DEBUG"):
+                    miscutils.fwdebug_print("Could not save inclfunc cache entry for %s: %s" %
+                                            (key, err))
+
+
+def inclfunc_cache_from_env():
+    """Return InclfuncCache configured from environment or None if not set.
+    """
+    cachedir = os.environ.get(intgdefs.WCL_INCLFUNC_CACHE_ENV) or None
+    ttl = os.environ.get(intgdefs.WCL_INCLFUNC_CACHE_TTL_ENV)
+    if cachedir is None and ttl is None:
+        return None
+    if ttl is None:
+        ttl = intgdefs.WCL_INCLFUNC_CACHE_TTL
+    elif ttl.lower() == 'none':
+        ttl = None
+    else:
+        ttl = float(ttl)
+    return InclfuncCache(cachedir, ttl)